@@ -47,6 +47,7 @@ The nature of your original system is otherwise unconstrained.
 import sys
 sys.path.append("cs224u")
 
+import functools
 import os
 import pandas as pd
 from compgen import check_set_equal_neoD as recogs_exact_match
@@ -64,24 +65,143 @@ SRC_DIRNAME = os.path.join("data", "recogs")
 
 """## Load the COGS and ReCOGS datasets"""
 
-def load_split(filename):
-    return pd.read_csv(
-        filename,
-        delimiter="\t",
-        names=['input', 'output', 'category'])
+SPLIT_TSV_KWARGS = {"delimiter": "\t", "names": ['input', 'output', 'category']}
 
-dataset = {}
+def load_split(filename, columns=None, **tsv_kwargs):
+    """Load a split, preferring the Arrow IPC copy written by
+    `convert_split` and falling back to the TSV `filename`.
 
-for splitname in ("train", "dev", "gen"):
-    dataset[splitname] = load_split(f"{SRC_DIRNAME}/{splitname}.tsv")
-
-"""Here's a look at the dataset. Fundamentally, the task is to map simple English sentences to logical forms. For ReCOGS, you need only predict these forms up to semantic equivalence, which means that we abstract away from the order of the conjuncts and the names of specific variables."""
+    Parameters
+    ----------
+    filename: str
+        The TSV file.
+    columns: list of str or None
+        Load only these columns.
+    **tsv_kwargs
+        Passed to `pd.read_csv` when reading the TSV. Default:
+        `SPLIT_TSV_KWARGS`.
 
-dataset['train'].head(2)
+    Returns
+    -------
+    pd.DataFrame
+    """
+    arrow_filename = get_arrow_filename(filename)
+    if pa is not None and _is_up_to_date(arrow_filename, filename):
+        # Uncompressed and memory-mapped, so columns are only paged in
+        # as they are used:
+        table = pyarrow.feather.read_table(
+            arrow_filename, columns=columns, memory_map=True)
+        return table.to_pandas()
+    df = pd.read_csv(filename, **(tsv_kwargs or SPLIT_TSV_KWARGS))
+    if columns is not None:
+        df = df[columns]
+    return df
+
+"""### Columnar storage
+
+Parsing the TSVs creates a Python string for every cell, every time. `convert_split` writes a one-time Arrow IPC (Feather v2) copy of a split next to its TSV, with `category` stored as a categorical column, and `load_split` reads that copy memory-mapped whenever it is at least as new as the TSV. `pyarrow` is optional; without it, `load_split` just reads the TSVs."""
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.feather
+except ImportError:
+    pa = None
+
+def get_arrow_filename(filename):
+    return os.path.splitext(filename)[0] + ".arrow"
+
+def _is_up_to_date(target, source):
+    return (
+        os.path.exists(target)
+        and os.path.getmtime(target) >= os.path.getmtime(source))
+
+def convert_split(filename, **tsv_kwargs):
+    """Write the TSV split `filename` as an uncompressed Arrow IPC
+    file with `category` as a categorical column.
 
-"""The `dataset['gen']` section is divided up into different 21 categories. A category name `X_to_Y` or `only_seen_as_X_as_Y`  means that specific phrases were seen only as `X` in training and will encounter those phrases as `Y` at test time."""
+    Parameters
+    ----------
+    filename: str
+    **tsv_kwargs
+        As for `load_split`.
 
-sorted(dataset['gen'].category.unique())
+    Returns
+    -------
+    str
+        The name of the Arrow file
+    """
+    if pa is None:
+        raise ImportError("Converting splits requires `pyarrow`.")
+    df = pd.read_csv(filename, **(tsv_kwargs or SPLIT_TSV_KWARGS))
+    if "category" in df.columns:
+        df["category"] = df["category"].astype("category")
+    arrow_filename = get_arrow_filename(filename)
+    tmp_filename = f"{arrow_filename}.tmp"
+    pyarrow.feather.write_feather(
+        df, tmp_filename, compression="uncompressed")
+    os.replace(tmp_filename, arrow_filename)
+    return arrow_filename
+
+def convert_splits(dirname=SRC_DIRNAME):
+    """Convert the train, dev, gen, and bakeoff splits in `dirname`."""
+    filenames = []
+    for splitname in ("train", "dev", "gen"):
+        filenames.append(convert_split(os.path.join(dirname, f"{splitname}.tsv")))
+    filenames.append(convert_split(
+        os.path.join(dirname, "cs224u-recogs-test-unlabeled.tsv"),
+        sep="\t", index_col=0))
+    return filenames
+
+# convert_splits()
+
+def benchmark_load_split(filename, columns=None, repeat=3):
+    """Measure the time and RSS increase of loading `filename` from
+    the TSV and from its Arrow copy, which is created if necessary.
+    The RSS numbers are only indicative, as they are measured
+    in-process."""
+    arrow_filename = get_arrow_filename(filename)
+    if not _is_up_to_date(arrow_filename, filename):
+        convert_split(filename)
+    loaders = {
+        "tsv": lambda: pd.read_csv(filename, **SPLIT_TSV_KWARGS),
+        "arrow": lambda: load_split(filename, columns=columns)}
+    results = {}
+    for name, loader in loaders.items():
+        gc.collect()
+        rss_before = get_rss()
+        df = loader()
+        rss_delta = get_rss() - rss_before
+        del df
+        gc.collect()
+        best = min(timeit.repeat(loader, number=1, repeat=repeat))
+        results[name] = {"seconds": best, "rss_delta_mb": rss_delta / 1e6}
+        print(f"{name}: {best:.3f}s, RSS +{rss_delta / 1e6:.1f}MB")
+    return results
+
+# benchmark_load_split(os.path.join(SRC_DIRNAME, "train.tsv"))
+
+"""Nothing is loaded when this module is imported. The splits, tokenizers, and pretrained model are loaded on first use by cached accessors like `get_dataset`. The old module-level names (`dataset`, `enc_tokenizer`, `encdec`, `recogs_model`, and so on) still work as attributes of the imported module (see `__getattr__` at the end of this file), and the exploratory cells only run when this file is executed as a script."""
+
+@functools.lru_cache(maxsize=None)
+def get_dataset():
+    """Dict mapping "train", "dev", and "gen" to their splits, loaded
+    on the first call and shared after that. Copy a split before
+    modifying it."""
+    return {
+        splitname: load_split(f"{SRC_DIRNAME}/{splitname}.tsv")
+        for splitname in ("train", "dev", "gen")}
+
+if __name__ == "__main__":
+    dataset = get_dataset()
+
+    """Here's a look at the dataset. Fundamentally, the task is to map simple English sentences to logical forms. For ReCOGS, you need only predict these forms up to semantic equivalence, which means that we abstract away from the order of the conjuncts and the names of specific variables."""
+
+    dataset['train'].head(2)
+
+    """The `dataset['gen']` section is divided up into different 21 categories. A category name `X_to_Y` or `only_seen_as_X_as_Y`  means that specific phrases were seen only as `X` in training and will encounter those phrases as `Y` at test time."""
+
+    sorted(dataset['gen'].category.unique())
 
 """## Question 1: Proper names and their semantic roles
 
@@ -101,6 +221,14 @@ To do the above, you just need to complete the function `get_propername_role`. T
 """
 
 import re
+import timeit
+
+# Single-pass pattern for ReCOGS logical forms. Each match is either a
+# "Name ( var )" expression (groups 1-2) or a "role ( var , var )"
+# expression (groups 3-5):
+LF_BINDING_RE = re.compile(
+    r'([A-Z][a-z]*) \( (\d+) \)'
+    r'|(agent|theme|recipient) \(\s*(\d+)\s*,\s*(\d+)\s*\)')
 
 def get_propername_role(s):
     """Extract from `s` all the pairs `(name, role)` determined by
@@ -111,9 +239,40 @@ def get_propername_role(s):
     "agent ( 4 , 1 )" and "theme ( 6 , 1 )". Your function should
     cover all these cases.
 
-    We've suggested a particular program design to get you started,
-    but you are free to do something different and perhaps cleverer
-    if you wish!
+    This makes a single scan over `s` with `LF_BINDING_RE`, building
+    a variable-to-names index and a variable-to-roles index as it
+    goes, and then joins the two indices on the variable. As in the
+    original nested-loop design (`get_propername_role_nested`), a
+    name binds into a role if its variable is either of the role's
+    variables.
+
+    Parameters
+    ----------
+    s: str
+
+    Returns
+    -------
+    set of tuples `(name, role)` where `name` and `role` are str
+    """
+    var2names = {}
+    var2roles = {}
+    for name, name_var, role, event_var, arg_var in LF_BINDING_RE.findall(s):
+        if name:
+            var2names.setdefault(name_var, set()).add(name)
+        else:
+            var2roles.setdefault(event_var, set()).add(role)
+            var2roles.setdefault(arg_var, set()).add(role)
+    data = set()
+    for var, names in var2names.items():
+        for role in var2roles.get(var, ()):
+            for name in names:
+                data.add((name, role))
+    return data
+
+def get_propername_role_nested(s):
+    """The original nested-regex version of `get_propername_role`,
+    which does O(names x roles) work per LF. It is kept as a
+    reference for `benchmark_get_propername_role`.
 
     Parameters
     ----------
@@ -204,23 +363,85 @@ def test_get_propername_role(func):
 
 # test_get_propername_role(get_propername_role)
 
+"""The single-pass parser should agree with the original nested-regex version on every LF while being considerably faster. This micro-benchmark checks both things:"""
+
+def benchmark_get_propername_role(lfs,
+        funcs=(get_propername_role_nested, get_propername_role),
+        repeat=3):
+    """Time each function in `funcs` over all of `lfs`, reporting the
+    best of `repeat` runs, and check that all the functions return the
+    same `(name, role)` sets.
+
+    Parameters
+    ----------
+    lfs: iterable of str
+        For example, `dataset['train'].output`.
+    funcs: sequence of functions
+        The first is treated as the baseline for speed-ups.
+    repeat: int
+
+    Returns
+    -------
+    dict mapping function names to their best time in seconds
+    """
+    lfs = list(lfs)
+    expected = [funcs[0](s) for s in lfs]
+    timings = {}
+    for func in funcs:
+        results = [func(s) for s in lfs]
+        mismatches = sum(r != e for r, e in zip(results, expected))
+        if mismatches:
+            print(f"Error for `{func.__name__}`: "
+                  f"{mismatches} results differ from `{funcs[0].__name__}`")
+        best = min(timeit.repeat(
+            lambda: [func(s) for s in lfs], number=1, repeat=repeat))
+        timings[func.__name__] = best
+    baseline = timings[funcs[0].__name__]
+    for name, best in timings.items():
+        print(f"{name}: {best:.3f}s for {len(lfs)} LFs "
+              f"({baseline / best:.1f}x)")
+    return timings
+
+# benchmark_get_propername_role(dataset['train'].output)
+
 """### Task 2: Finding challenging names [1 point]
 
 You can now use your code to find the names that will be the most challenging because their train/gen roles are disjoint. To do this, you just need to complete the function `find_name_roles`:
 """
 
 from collections import defaultdict
+import concurrent.futures
+import multiprocessing
 
-def find_name_roles(split_df, colname="output"):
+import numpy as np
+
+def find_name_roles(split_df, colname="output", chunksize=None, n_jobs=1,
+        func=None):
     """Create a map from names to dicts mapping roles to counts: the
-    number of time the name appears with role in `split_df`:
+    number of time the name appears with role in `split_df`.
 
     Parameters
     ----------
-    split_df : pd.DataFrame
-        Needs to have a column called `colname`.
+    split_df : pd.DataFrame or str
+        Needs to have a column called `colname`. If this is a str, it
+        is taken to be the filename of a ReCOGS TSV split, which is
+        streamed from disk in pieces of `chunksize` rows.
     colname: str
-        Column to target with `get_propername_role`. Default: "output".
+        Column to target with `func`. Default: "output".
+    chunksize: int or None
+        Number of rows to process at a time. If None, the whole column
+        is done at once.
+    n_jobs: int
+        Number of worker processes. Each chunk is sharded across the
+        workers, which return partial counts that are then summed
+        here, so the results are identical to the serial version. -1
+        means use all CPUs. Default: 1.
+    func: function or None
+        A function like `get_propername_role`, applied row by row.
+        Must be picklable (i.e., defined at module level) if
+        `n_jobs > 1`. If None, the whole column is processed at once
+        by `count_name_roles_vectorized` when `pyarrow` is available,
+        and by `get_propername_role` otherwise.
 
     Returns
     -------
@@ -229,18 +450,244 @@ def find_name_roles(split_df, colname="output"):
     # This is a convenient way to create a multidimensional count dict:
     # You can access it out of the box as `all_roles[key1][key2] += 1`.
     all_roles = defaultdict(lambda : defaultdict(int))
-    
-    # Apply `get_propername_role` to every value in the target column
-    # and aggregate the results into `all_roles`:
-    ##### YOUR CODE HERE
-    for s in split_df[colname]:
-        propername_role_tuples = get_propername_role(s)
-        for name, role in propername_role_tuples:
-            all_roles[name][role] += 1
+    n_jobs = resolve_n_jobs(n_jobs)
+    pool = get_process_pool(n_jobs) if n_jobs > 1 else None
+    if func is None and pa is not None:
+        count_func = count_name_roles_vectorized
+    else:
+        count_func = functools.partial(
+            count_name_roles, func=func or get_propername_role)
+    try:
+        for col in _iter_column_chunks(split_df, colname, chunksize):
+            if n_jobs > 1:
+                partials = map_shards(count_func, col, n_jobs, pool=pool)
+            else:
+                partials = [count_func(col)]
+            for counts in partials:
+                for (name, role), count in counts.items():
+                    all_roles[name][role] += count
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return all_roles
 
+def count_name_roles(lfs, func=get_propername_role):
+    """Count the `(name, role)` pairs that `func` finds in each of
+    `lfs`.
 
-    # Return `all_roles`:
-    return all_roles
+    Parameters
+    ----------
+    lfs: iterable of str
+    func: function
+
+    Returns
+    -------
+    `defaultdict` mapping `(name, role)` to counts
+    """
+    counts = defaultdict(int)
+    for s in lfs:
+        for name_role in func(s):
+            counts[name_role] += 1
+    return counts
+
+NAME_ROLES = ("agent", "theme", "recipient")
+
+def count_name_roles_vectorized(lfs):
+    """Column-wise version of `count_name_roles` for
+    `get_propername_role`, built on `pyarrow.compute`.
+
+    All of `lfs` is split into one flat array of tokens (dropping
+    commas, so that "agent ( 6, 243 )" is handled like
+    "agent ( 6 , 243 )"), with the row of each token. Names are the
+    tokens followed by "( var )", and roles are the members of
+    `NAME_ROLES` followed by "( var var )". Each name is keyed on its
+    (row, variable) pair, each role is looked up under the keys for
+    both of its variables, and the distinct (row, name, role) triples
+    are then counted with `np.bincount`. No Python code runs per row
+    or per token.
+
+    Parameters
+    ----------
+    lfs: iterable of str
+        Whitespace-tokenized ReCOGS LFs.
+
+    Returns
+    -------
+    `defaultdict` mapping `(name, role)` to counts
+    """
+    pc = pyarrow.compute
+    if isinstance(lfs, pd.Series):
+        lfs = lfs.array
+    lfs = pa.array(lfs, type=pa.large_string())
+    if isinstance(lfs, pa.ChunkedArray):
+        lfs = lfs.combine_chunks()
+    lists = pc.ascii_split_whitespace(pc.replace_substring(lfs, ",", " "))
+    # Two padding tokens, in no row, let every position below look
+    # four tokens ahead:
+    tokens = pa.concat_arrays([
+        pc.list_flatten(lists), pa.array(["", ""], type=pa.large_string())])
+    rows = np.concatenate([
+        pc.list_parent_indices(lists).to_numpy().astype(np.int64), [-1, -1]])
+    counts = defaultdict(int)
+    # Every predicate is directly followed by "(", so only these
+    # positions need to be checked:
+    heads = np.flatnonzero(
+        pc.equal(tokens, "(").to_numpy(zero_copy_only=False)) - 1
+    heads = heads[heads >= 0]
+    heads = heads[rows[heads] == rows[heads + 3]]
+    if len(heads) == 0:
+        return counts
+
+    def take(offset, index=heads):
+        return pc.take(tokens, index + offset)
+
+    def is_var(offset, index=heads):
+        return pc.ascii_is_decimal(take(offset, index))
+
+    def to_var(offset, index):
+        return pc.cast(take(offset, index), pa.int64()).to_numpy()
+
+    def to_numpy(mask):
+        return pc.fill_null(mask, False).to_numpy(zero_copy_only=False)
+
+    head_tokens = take(0)
+    is_name = to_numpy(pc.and_(
+        pc.match_substring_regex(head_tokens, r"^[A-Z][a-z]*$"),
+        pc.and_(is_var(2), pc.equal(take(3), ")"))))
+    role_codes = pc.index_in(head_tokens, value_set=pa.array(NAME_ROLES))
+    is_role = to_numpy(pc.and_(
+        pc.is_valid(role_codes),
+        pc.and_(pc.and_(is_var(2), is_var(3)), pc.equal(take(4), ")"))))
+    is_role &= rows[heads] == rows[heads + 4]
+    name_heads = heads[is_name]
+    role_heads = heads[is_role]
+    if len(name_heads) == 0 or len(role_heads) == 0:
+        return counts
+    # Names, sorted on a (row, variable) key:
+    names = pc.dictionary_encode(take(0, name_heads))
+    name_codes = names.indices.to_numpy().astype(np.int64)
+    name_vars = to_var(2, name_heads)
+    role_vars = np.concatenate(
+        [to_var(2, role_heads), to_var(3, role_heads)])
+    width = int(max(name_vars.max(), role_vars.max())) + 1
+    name_keys = rows[name_heads] * width + name_vars
+    order = np.argsort(name_keys, kind="stable")
+    name_keys = name_keys[order]
+    name_codes = name_codes[order]
+    # Each role under both of its variables, joined to the names:
+    role_codes = role_codes.to_numpy(zero_copy_only=False)[is_role]
+    role_codes = np.concatenate([role_codes, role_codes]).astype(np.int64)
+    role_rows = np.concatenate([rows[role_heads], rows[role_heads]])
+    role_keys = role_rows * width + role_vars
+    starts = np.searchsorted(name_keys, role_keys, side="left")
+    stops = np.searchsorted(name_keys, role_keys, side="right")
+    # A variable can carry more than one name, so repeat each role
+    # once per matching name:
+    n_matches = stops - starts
+    role_index = np.repeat(np.arange(len(role_keys)), n_matches)
+    name_index = (
+        np.arange(n_matches.sum())
+        - np.repeat(np.cumsum(n_matches) - n_matches, n_matches)
+        + np.repeat(starts, n_matches))
+    n_pairs = len(names.dictionary) * len(NAME_ROLES)
+    pairs = name_codes[name_index] * len(NAME_ROLES) + role_codes[role_index]
+    triples = np.unique(role_rows[role_index] * n_pairs + pairs)
+    pair_counts = np.bincount(triples % n_pairs, minlength=n_pairs)
+    name_strs = names.dictionary.to_pylist()
+    for pair in np.flatnonzero(pair_counts):
+        name, role = divmod(int(pair), len(NAME_ROLES))
+        counts[(name_strs[name], NAME_ROLES[role])] = int(pair_counts[pair])
+    return counts
+
+def _iter_column_chunks(split_df, colname, chunksize):
+    if isinstance(split_df, str):
+        reader = pd.read_csv(
+            split_df,
+            delimiter="\t",
+            names=['input', 'output', 'category'],
+            usecols=[colname],
+            chunksize=chunksize or 100000)
+        for chunk in reader:
+            yield chunk[colname]
+    else:
+        col = split_df[colname]
+        chunksize = chunksize or max(len(col), 1)
+        for start in range(0, len(col), chunksize):
+            yield col.iloc[start: start + chunksize]
+
+"""The following helpers shard any per-row LF analysis across a process pool. `map_shards` applies a function to contiguous shards, leaving the reduction to the caller, and `parallel_apply` is the per-row special case, for functions like `get_propername_role`:"""
+
+def resolve_n_jobs(n_jobs):
+    """Map `n_jobs=-1` to the number of CPUs, as in scikit-learn."""
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, os.cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+def get_process_pool(n_jobs):
+    """A `ProcessPoolExecutor` with `n_jobs` workers. Where the
+    platform allows it, workers are forked, so that they inherit this
+    module's state rather than re-importing it."""
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    else:
+        context = None
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=resolve_n_jobs(n_jobs), mp_context=context)
+
+def map_shards(func, values, n_jobs=1, pool=None):
+    """Split `values` into `n_jobs` contiguous shards and apply `func`
+    to each shard, in a process pool if `n_jobs > 1`.
+
+    Parameters
+    ----------
+    func: function
+        Maps a `np.array` of values to a partial result. Must be
+        picklable (i.e., defined at module level).
+    values: iterable
+    n_jobs: int
+        -1 means use all CPUs.
+    pool: `concurrent.futures.Executor` or None
+        An existing pool to use. If None and `n_jobs > 1`, a pool is
+        created and shut down by this function.
+
+    Returns
+    -------
+    list of the partial results, in shard order
+    """
+    values = np.asarray(values, dtype=object)
+    n_jobs = resolve_n_jobs(n_jobs)
+    shards = [shard for shard in np.array_split(values, n_jobs) if len(shard)]
+    if len(shards) <= 1:
+        return [func(shard) for shard in shards]
+    if pool is not None:
+        return list(pool.map(func, shards))
+    with get_process_pool(len(shards)) as pool:
+        return list(pool.map(func, shards))
+
+def parallel_apply(func, values, n_jobs=1, pool=None):
+    """Apply `func` to every member of `values`, sharding the work
+    across `n_jobs` processes.
+
+    Parameters
+    ----------
+    func: function
+        A picklable per-row function like `get_propername_role`.
+    values: iterable
+    n_jobs: int
+    pool: `concurrent.futures.Executor` or None
+
+    Returns
+    -------
+    list of `func(v)` for `v` in `values`, in order
+    """
+    parts = map_shards(
+        functools.partial(_apply_rows, func), values, n_jobs, pool=pool)
+    return [result for part in parts for result in part]
+
+def _apply_rows(func, values):
+    return [func(v) for v in values]
 
 """A quick test:"""
 
@@ -267,15 +714,101 @@ def test_find_name_roles(func):
 
 # test_find_name_roles(find_name_roles)
 
+"""A comparison of the two row-by-row versions of `get_propername_role` inside `find_name_roles` with the column-wise `count_name_roles_vectorized`:"""
+
+def benchmark_find_name_roles(split_df, colname="output", chunksize=None,
+        repeat=3):
+    """Time `find_name_roles` on `split_df` with the original
+    `get_propername_role_nested`, with the single-pass
+    `get_propername_role`, and with `count_name_roles_vectorized`,
+    reporting the best of `repeat` runs, and check that all of them
+    return the same counts.
+
+    Parameters
+    ----------
+    split_df : pd.DataFrame
+    colname: str
+    chunksize: int or None
+        Passed to `find_name_roles`.
+    repeat: int
+
+    Returns
+    -------
+    dict mapping descriptions to best times in seconds
+    """
+    runs = {
+        "get_propername_role_nested": lambda: find_name_roles(
+            split_df, colname=colname, chunksize=chunksize,
+            func=get_propername_role_nested),
+        "get_propername_role": lambda: find_name_roles(
+            split_df, colname=colname, chunksize=chunksize,
+            func=get_propername_role)}
+    if pa is not None:
+        runs["count_name_roles_vectorized"] = lambda: find_name_roles(
+            split_df, colname=colname, chunksize=chunksize)
+    timings = {}
+    expected = None
+    for name, run in runs.items():
+        result = run()
+        if expected is None:
+            expected = result
+        elif result != expected:
+            print(f"Error for {name}: counts differ from the original version")
+        timings[name] = min(timeit.repeat(run, number=1, repeat=repeat))
+    baseline = timings["get_propername_role_nested"]
+    for name, best in timings.items():
+        print(f"{name}: {best:.3f}s for {split_df.shape[0]} rows "
+              f"({baseline / best:.1f}x)")
+    return timings
+
+# benchmark_find_name_roles(dataset['train'])
+
+"""And a scaling benchmark for the multiprocess version:"""
+
+def benchmark_find_name_roles_scaling(split_df, colname="output",
+        n_jobs_values=(1, 2, 4, 8), repeat=3):
+    """Time `find_name_roles` with each of `n_jobs_values` workers,
+    reporting the best of `repeat` runs, and check that all the
+    results are identical to the serial one.
+
+    Parameters
+    ----------
+    split_df : pd.DataFrame
+    colname: str
+    n_jobs_values: iterable of int
+    repeat: int
+
+    Returns
+    -------
+    dict mapping `n_jobs` values to best times in seconds
+    """
+    expected = find_name_roles(split_df, colname=colname)
+    timings = {}
+    for n_jobs in n_jobs_values:
+        result = find_name_roles(split_df, colname=colname, n_jobs=n_jobs)
+        if result != expected:
+            print(f"Error for `find_name_roles` with n_jobs={n_jobs}: "
+                  "counts differ from the serial version")
+        timings[n_jobs] = min(timeit.repeat(
+            lambda: find_name_roles(split_df, colname=colname, n_jobs=n_jobs),
+            number=1, repeat=repeat))
+    baseline = timings[min(timings)]
+    for n_jobs, best in timings.items():
+        print(f"n_jobs={n_jobs}: {best:.3f}s ({baseline / best:.1f}x)")
+    return timings
+
+# benchmark_find_name_roles_scaling(dataset['train'])
+
 """Once the test passes, this analysis should be informative:"""
 
-train_roles = find_name_roles(dataset['train'])
+if __name__ == "__main__":
+    train_roles = find_name_roles(dataset['train'])
 
-sorted(train_roles.items(), key=lambda x: len(x[1]))[: 3]
+    sorted(train_roles.items(), key=lambda x: len(x[1]))[: 3]
 
-gen_roles = find_name_roles(dataset["gen"])
+    gen_roles = find_name_roles(dataset["gen"])
 
-sorted(gen_roles.items(), key=lambda x: len(x[1]))[: 3]
+    sorted(gen_roles.items(), key=lambda x: len(x[1]))[: 3]
 
 """We will return to these troublemakers in a bit.
 
@@ -288,29 +821,52 @@ We launch now into an extended interlude before Question 2. For Question 2, you
 Here is a function for creating Hugging Face `PreTrainedTokenizerFast` tokenizers based on a provided vocab file. It pretty much just splits on whitespace and adds special tokens. Chris originally planned to have writing this be a homework question, but it turned out to be very difficult and confusing for him to write, so he decided to just present it to you in the hope that it helps you with similar tasks in the future.
 """
 
-from tokenizers import Tokenizer
-from tokenizers.models import WordLevel
-from tokenizers.pre_tokenizers import WhitespaceSplit
-from tokenizers.processors import TemplateProcessing
-from transformers import PreTrainedTokenizerFast
-
-
-def get_tokenizer(vocab_filename):
-    with open(vocab_filename) as f:
-        vocab = f.read().splitlines()
-    vocab_size = len(vocab)
-    vocab = dict(zip(vocab, list(range(vocab_size))))
-    tok = Tokenizer(WordLevel(vocab, unk_token='[UNK]'))
-    # This definitely needs to be done here and in the construction of
-    # `PreTrainedTokenizerFast`. Don't be tempted to "clean this up"!
-    tok.add_special_tokens(["[BOS]", "[UNK]", "[PAD]", "[EOS]"])
-    tok.pre_tokenizer = WhitespaceSplit()
-    tok.post_processor = TemplateProcessing(
-        single=f"[BOS]:0 $A:0 [EOS]:0",
-        special_tokens=[
-            ("[BOS]", tok.token_to_id("[BOS]")),
-            ("[EOS]", tok.token_to_id("[EOS]"))])
-    return PreTrainedTokenizerFast(
+import hashlib
+
+
+def file_hash(filename):
+    """SHA-1 hex digest of the contents of `filename`."""
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def build_tokenizer(vocab_filename, tokenizer_json_filename=None):
+    """Build a tokenizer from `vocab_filename`. If
+    `tokenizer_json_filename` is given, the underlying `Tokenizer` is
+    loaded from that file when it is at least as new as the vocab file,
+    and is otherwise built and then saved there."""
+    # Imported here so that importing this module stays cheap:
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import WhitespaceSplit
+    from tokenizers.processors import TemplateProcessing
+    from transformers import PreTrainedTokenizerFast
+
+    if (tokenizer_json_filename is not None
+            and _is_up_to_date(tokenizer_json_filename, vocab_filename)):
+        tok = Tokenizer.from_file(tokenizer_json_filename)
+    else:
+        with open(vocab_filename) as f:
+            vocab = f.read().splitlines()
+        vocab_size = len(vocab)
+        vocab = dict(zip(vocab, list(range(vocab_size))))
+        tok = Tokenizer(WordLevel(vocab, unk_token='[UNK]'))
+        # This definitely needs to be done here and in the construction of
+        # `PreTrainedTokenizerFast`. Don't be tempted to "clean this up"!
+        tok.add_special_tokens(["[BOS]", "[UNK]", "[PAD]", "[EOS]"])
+        tok.pre_tokenizer = WhitespaceSplit()
+        tok.post_processor = TemplateProcessing(
+            single=f"[BOS]:0 $A:0 [EOS]:0",
+            special_tokens=[
+                ("[BOS]", tok.token_to_id("[BOS]")),
+                ("[EOS]", tok.token_to_id("[EOS]"))])
+        if tokenizer_json_filename is not None:
+            tmp_filename = f"{tokenizer_json_filename}.tmp"
+            tok.save(tmp_filename)
+            os.replace(tmp_filename, tokenizer_json_filename)
+    tokenizer = PreTrainedTokenizerFast(
         tokenizer_object=tok,
         bos_token="[BOS]",
         unk_token="[UNK]",
@@ -319,20 +875,335 @@ def get_tokenizer(vocab_filename):
         # This vital; otherwise any periods will have their leading
         # spaces removed, which is wrong for COGS/ReCOGS.
         clean_up_tokenization_spaces=False)
+    # Used by `TokenCache` to recognize tokenizers built from this file:
+    tokenizer.vocab_hash = file_hash(vocab_filename)
+    return tokenizer
+
+"""Every `RecogsModel` needs two of these tokenizers, so `get_tokenizer` keeps a process-wide registry of them, keyed by the vocab file's path and modification time. All callers share the same instances, so treat them as read-only, or ask for a private copy with `private=True`. With `serialize=True`, the built tokenizer is also saved as JSON next to the vocab file, which is faster to load in a new process than rebuilding it."""
+
+import copy
+import threading
+
+_TOKENIZER_REGISTRY = {}
+
+_TOKENIZER_REGISTRY_LOCK = threading.Lock()
+
+def get_tokenizer_json_filename(vocab_filename):
+    return os.path.splitext(vocab_filename)[0] + ".tokenizer.json"
+
+def get_tokenizer(vocab_filename, serialize=False, private=False):
+    """The shared tokenizer for `vocab_filename`, built on first use and
+    rebuilt if the vocab file changes.
+
+    Parameters
+    ----------
+    vocab_filename: str
+    serialize: bool
+        Load the tokenizer from, or save it to, the file given by
+        `get_tokenizer_json_filename`.
+    private: bool
+        Return a deep copy of the shared tokenizer (about 0.2ms) rather
+        than the shared instance itself.
+
+    Returns
+    -------
+    `PreTrainedTokenizerFast`
+        Unless `private=True`, this is the instance shared by every
+        caller, including all `RecogsModel`s, and it is not guarded
+        against changes: adding tokens or changing settings on it
+        affects all of them, and `TokenCache` would go on keying its
+        entries by the unchanged vocab file. Use `private=True` for a
+        tokenizer you intend to modify. Its `TokenCache` entries are
+        keyed by the serialized tokenizer instead, as for tokenizers
+        not created here.
+    """
+    path = os.path.abspath(vocab_filename)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _TOKENIZER_REGISTRY_LOCK:
+        tokenizer = _TOKENIZER_REGISTRY.get(key)
+        if tokenizer is None:
+            tokenizer_json_filename = None
+            if serialize:
+                tokenizer_json_filename = get_tokenizer_json_filename(path)
+            tokenizer = build_tokenizer(path, tokenizer_json_filename)
+            # Drop any stale entry for an earlier version of the file:
+            for stale_key in [k for k in _TOKENIZER_REGISTRY if k[0] == path]:
+                del _TOKENIZER_REGISTRY[stale_key]
+            _TOKENIZER_REGISTRY[key] = tokenizer
+    if private:
+        tokenizer = copy.deepcopy(tokenizer)
+        del tokenizer.vocab_hash
+    return tokenizer
+
+def benchmark_get_tokenizer(vocab_filename, repeat=5):
+    """Time building a tokenizer from the vocab file, loading it from
+    its JSON serialization, and fetching it from the registry."""
+    tokenizer_json_filename = get_tokenizer_json_filename(vocab_filename)
+    build_tokenizer(vocab_filename, tokenizer_json_filename)
+    timings = {
+        "build": lambda: build_tokenizer(vocab_filename),
+        "from json": lambda: build_tokenizer(
+            vocab_filename, tokenizer_json_filename),
+        "registry": lambda: get_tokenizer(vocab_filename)}
+    results = {}
+    for name, func in timings.items():
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print(f"{name}: {results[name] * 1000:.2f}ms")
+    return results
+
+# benchmark_get_tokenizer(os.path.join(SRC_DIRNAME, "src_vocab.txt"))
 
 """We will have separate tokens for the encoder and the decoder:"""
 
-enc_tokenizer = get_tokenizer(os.path.join(SRC_DIRNAME, "src_vocab.txt"))
+def get_enc_tokenizer():
+    return get_tokenizer(os.path.join(SRC_DIRNAME, "src_vocab.txt"))
+
+def get_dec_tokenizer():
+    return get_tokenizer(os.path.join(SRC_DIRNAME, "tgt_vocab.txt"))
+
+if __name__ == "__main__":
+    enc_tokenizer = get_enc_tokenizer()
+
+    enc_tokenizer.tokenize(
+        "A sailor was helped", 
+        add_special_tokens=True)
+
+    dec_tokenizer = get_dec_tokenizer()
+
+    dec_tokenizer.tokenize(
+        "sailor ( 53 ) ; help ( 7 ) AND theme ( 7 , 53 )", 
+        add_special_tokens=True)
+
+"""### Tokenization cache
+
+Tokenizing the full train split is paid again every time a model is built, fit, or asked to predict. To avoid that, `TokenCache` stores token ids on disk as one flat `int32` array per column plus an offsets index, loaded memory-mapped as a `TokenizedColumn`. Entries are keyed by a hash of the column's strings plus a hash of the tokenizer's vocab file, so they are used only when both match exactly.
+"""
+
+import gc
+import itertools
+import math
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; see `get_peak_rss`.
+    resource = None
+
+TOKEN_CACHE_DIRNAME = os.path.join(SRC_DIRNAME, "token_cache")
+
+def texts_hash(texts):
+    """SHA-1 hex digest of the sequence of strings `texts`."""
+    sha = hashlib.sha1()
+    for s in texts:
+        sha.update(s.encode("utf8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash identifying the vocabulary of `tokenizer`. For tokenizers
+    from `get_tokenizer`, this is the hash of the vocab file. For other
+    fast tokenizers, it is the hash of the serialized tokenizer, which
+    is computed once and stored on the tokenizer. Slow tokenizers have
+    no fingerprint, and so they are never cached."""
+    fingerprint = getattr(tokenizer, "vocab_hash", None)
+    if fingerprint is None and getattr(tokenizer, "is_fast", False):
+        serialized = tokenizer.backend_tokenizer.to_str()
+        fingerprint = hashlib.sha1(serialized.encode("utf8")).hexdigest()
+        tokenizer.vocab_hash = fingerprint
+    return fingerprint
+
+def _batch_encode(tokenizer, texts):
+    """Equivalent to `[tokenizer.encode(s) for s in texts]`. For fast
+    tokenizers, this goes straight to the Rust `encode_batch`, which
+    parallelizes over `texts` and avoids most of the per-example
+    overhead of `PreTrainedTokenizerFast.__call__`."""
+    if getattr(tokenizer, "is_fast", False):
+        encodings = tokenizer.backend_tokenizer.encode_batch(
+            texts, add_special_tokens=True)
+        return [e.ids for e in encodings]
+    return tokenizer(texts, add_special_tokens=True)["input_ids"]
+
+class TokenizedColumn:
+    """Token ids for a sequence of strings, stored as a flat `ids` array
+    and an `offsets` array of length `n + 1`, so that the ids for
+    example `i` are `ids[offsets[i]: offsets[i+1]]`. A column made by
+    `take` also has `rows`, mapping its examples to rows of the
+    original arrays, which it shares."""
+    def __init__(self, ids, offsets, rows=None):
+        self.ids = ids
+        self.offsets = offsets
+        self.rows = rows
+
+    @classmethod
+    def from_texts(cls, tokenizer, texts, chunksize=10000):
+        """Tokenize `texts` with batched calls to `tokenizer`, each
+        covering at most `chunksize` strings, so that Python lists of
+        ids exist only for one chunk at a time."""
+        texts = list(texts)
+        chunksize = chunksize or max(len(texts), 1)
+        lengths = []
+        ids = []
+        for start in range(0, len(texts), chunksize):
+            chunk = _batch_encode(tokenizer, texts[start: start + chunksize])
+            lengths.append(np.fromiter(
+                map(len, chunk), dtype=np.int64, count=len(chunk)))
+            ids.append(np.fromiter(
+                itertools.chain.from_iterable(chunk), dtype=np.int32))
+        lengths = np.concatenate(lengths) if lengths else np.zeros(0, np.int64)
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1: ])
+        ids = np.concatenate(ids) if ids else np.zeros(0, np.int32)
+        return cls(ids, offsets)
+
+    @classmethod
+    def from_lists(cls, id_lists):
+        lengths = np.fromiter(
+            map(len, id_lists), dtype=np.int64, count=len(id_lists))
+        offsets = np.zeros(len(id_lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1: ])
+        ids = np.fromiter(
+            (i for ex in id_lists for i in ex),
+            dtype=np.int32, count=offsets[-1])
+        return cls(ids, offsets)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode="r"):
+        return cls(
+            np.load(f"{prefix}.ids.npy", mmap_mode=mmap_mode),
+            np.load(f"{prefix}.offsets.npy", mmap_mode=mmap_mode))
+
+    def take(self, rows):
+        """The examples at `rows`, without copying any ids."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.rows is not None:
+            rows = self.rows[rows]
+        return TokenizedColumn(self.ids, self.offsets, rows=rows)
+
+    def save(self, prefix):
+        if self.rows is not None:
+            self = TokenizedColumn.from_lists([self[i] for i in range(len(self))])
+        # The offsets are written last, and `TokenCache` checks for them,
+        # so a partially written entry is never used:
+        for suffix, arr in (("ids", self.ids), ("offsets", self.offsets)):
+            tmp_filename = f"{prefix}.{suffix}.tmp.npy"
+            np.save(tmp_filename, arr)
+            os.replace(tmp_filename, f"{prefix}.{suffix}.npy")
+
+    @property
+    def lengths(self):
+        lengths = np.diff(self.offsets)
+        return lengths if self.rows is None else lengths[self.rows]
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if self.rows is not None:
+            idx = self.rows[idx]
+        return self.ids[self.offsets[idx]: self.offsets[idx+1]]
 
-enc_tokenizer.tokenize(
-    "A sailor was helped", 
-    add_special_tokens=True)
+class TokenCache:
+    """On-disk cache of `TokenizedColumn`s.
 
-dec_tokenizer = get_tokenizer(os.path.join(SRC_DIRNAME, "tgt_vocab.txt"))
+    Parameters
+    ----------
+    dirname: str
+        Where the cached arrays are stored. Created if necessary.
+    """
+    def __init__(self, dirname=TOKEN_CACHE_DIRNAME):
+        self.dirname = dirname
+        # Map tokenizer fingerprints to `(text_index, column)` pairs
+        # registered with `add_source`:
+        self.sources = {}
+
+    def __getstate__(self):
+        # The source indices are rebuilt cheaply and can be large:
+        state = self.__dict__.copy()
+        state["sources"] = {}
+        return state
+
+    def _prefix(self, texts, tokenizer):
+        fingerprint = tokenizer_fingerprint(tokenizer)
+        if fingerprint is None:
+            return None
+        key = f"{texts_hash(texts)}-{fingerprint}"
+        return os.path.join(self.dirname, key)
+
+    def get(self, texts, tokenizer):
+        """The cached `TokenizedColumn` for `texts`, memory-mapped, or
+        None if there is no cache entry."""
+        prefix = self._prefix(texts, tokenizer)
+        if prefix is None:
+            return None
+        if os.path.exists(f"{prefix}.offsets.npy"):
+            return TokenizedColumn.load(prefix)
+        for text_index, col in self.sources.get(tokenizer_fingerprint(tokenizer), []):
+            try:
+                rows = [text_index[text] for text in texts]
+            except KeyError:
+                continue
+            return col.take(rows)
+        return None
+
+    def add_source(self, texts, tokenizer):
+        """Cache `texts` if necessary and let `get` also serve any
+        sequence drawn from `texts`, like the train portion of a split
+        that `fit` divides for early stopping, as a view of that entry.
+
+        Returns
+        -------
+        `TokenizedColumn`
+        """
+        texts = list(texts)
+        col = self.get(texts, tokenizer)
+        if col is None:
+            col = self.put(texts, tokenizer)
+        text_index = {text: i for i, text in enumerate(texts)}
+        self.sources.setdefault(tokenizer_fingerprint(tokenizer), []).append(
+            (text_index, col))
+        return col
+
+    def put(self, texts, tokenizer):
+        """Tokenize `texts` with `tokenizer`, store the result, and
+        return the memory-mapped `TokenizedColumn`."""
+        texts = list(texts)
+        prefix = self._prefix(texts, tokenizer)
+        if prefix is None:
+            raise ValueError(
+                "Only fast tokenizers can be used with `TokenCache`.")
+        os.makedirs(self.dirname, exist_ok=True)
+        col = TokenizedColumn.from_texts(tokenizer, texts)
+        col.save(prefix)
+        return TokenizedColumn.load(prefix)
+
+def pretokenize_split(split_df, enc_tokenizer, dec_tokenizer, cache=None):
+    """Store the tokenized "input" and "output" columns of `split_df`
+    in `cache`, so that `RecogsDataset` instances built from these
+    columns (e.g., by `RecogsModel.fit`) can skip tokenization.
 
-dec_tokenizer.tokenize(
-    "sailor ( 53 ) ; help ( 7 ) AND theme ( 7 , 53 )", 
-    add_special_tokens=True)
+    Parameters
+    ----------
+    split_df: pd.DataFrame
+        For example, `dataset['train']`.
+    enc_tokenizer: `PreTrainedTokenizerFast`
+    dec_tokenizer: `PreTrainedTokenizerFast`
+    cache: `TokenCache` or None
+        If None, a `TokenCache` in `TOKEN_CACHE_DIRNAME` is used.
+
+    Returns
+    -------
+    `TokenCache`
+    """
+    cache = TokenCache() if cache is None else cache
+    for colname, tokenizer in (("input", enc_tokenizer), ("output", dec_tokenizer)):
+        if cache.get(split_df[colname], tokenizer) is None:
+            cache.put(split_df[colname], tokenizer)
+    return cache
+
+# pretokenize_split(dataset['train'], enc_tokenizer, dec_tokenizer)
 
 """### Dataset
 
@@ -342,27 +1213,50 @@ Next is a dataset utility. Chris was originally going to have you write this you
 import torch
 
 class RecogsDataset(torch.utils.data.Dataset):
-    def __init__(self, enc_tokenizer, dec_tokenizer, X, y=None):
-        self.X = [enc_tokenizer.encode(s) for s in X]
+    def __init__(self, enc_tokenizer, dec_tokenizer, X, y=None,
+            token_cache=None, chunksize=10000):
+        self.X = self._encode(enc_tokenizer, X, token_cache, chunksize)
         self.y = y
         if y is not None:
-            self.y = [dec_tokenizer.encode(s) for s in y]
+            self.y = self._encode(dec_tokenizer, y, token_cache, chunksize)
 
     @staticmethod
-    def collate_fn(batch):
+    def _encode(tokenizer, texts, token_cache, chunksize):
+        """Use the `TokenizedColumn` from `token_cache` if `texts` has
+        been cached with `tokenizer`, else tokenize `texts` in batches
+        of `chunksize`."""
+        if token_cache is not None:
+            col = token_cache.get(texts, tokenizer)
+            if col is not None:
+                return col
+        return TokenizedColumn.from_texts(tokenizer, texts, chunksize=chunksize)
+
+    @staticmethod
+    def collate_fn(batch, pin_memory=False):
         """Unfortunately, we can't pass the tokenizer in as an argument
         to this method, since it is a static method, so we need to do
-        the work of creating the necessary attention masks."""
+        the work of creating the necessary attention masks.
+
+        Each padded batch is a single preallocated tensor that the
+        examples are copied into through a zero-copy `numpy` view, and
+        the mask is computed in one vectorized comparison. With
+        `pin_memory=True` (and a GPU available), the tensors are
+        allocated in pinned memory, for fast host-to-device copies.
+        Use `functools.partial` to set this for a `DataLoader`."""
+        pin_memory = pin_memory and torch.cuda.is_available()
         def get_pad_and_mask(vals):
-            lens = [len(i) for i in vals]
-            maxlen = max(lens)
-            pad = []
-            mask = []
-            for ex, length in zip(vals, lens):
-                diff = maxlen - length
-                pad.append(ex + ([0] * diff))
-                mask.append(([1] * length) + ([0] * diff))
-            return torch.tensor(pad), torch.tensor(mask)
+            lens = torch.tensor([len(i) for i in vals])
+            maxlen = int(lens.max())
+            pad = torch.full(
+                (len(vals), maxlen), 0, dtype=torch.long, pin_memory=pin_memory)
+            pad_view = pad.numpy()
+            for i, ex in enumerate(vals):
+                pad_view[i, : len(ex)] = ex
+            mask = torch.arange(maxlen).unsqueeze(0) < lens.unsqueeze(1)
+            mask = mask.long()
+            if pin_memory:
+                mask = mask.pin_memory()
+            return pad, mask
         batch_elements = list(zip(*batch))
         X = batch_elements[0]
         X_pad, X_mask = get_pad_and_mask(X)
@@ -376,6 +1270,15 @@ class RecogsDataset(torch.utils.data.Dataset):
             # Hugging Face will calculate the loss for us.
             return X_pad, X_mask, y_pad, y_mask, y_pad
 
+    @property
+    def lengths(self):
+        """List of per-example length arrays, one for each padded
+        field: `[X lengths]` or `[X lengths, y lengths]`."""
+        lengths = [self.X.lengths]
+        if self.y is not None:
+            lengths.append(self.y.lengths)
+        return lengths
+
     def __len__(self):
         return len(self.X)
 
@@ -385,22 +1288,290 @@ class RecogsDataset(torch.utils.data.Dataset):
         else:
             return (self.X[idx], self.y[idx])
 
+"""Tokenizing with batched calls and storing `TokenizedColumn` arrays, rather than calling `encode` once per string and keeping lists of Python ints, makes datasets much faster to build and much smaller. This compares the two:"""
+
+def get_rss():
+    """Current resident set size of this process in bytes, or None
+    where `/proc` is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+def get_peak_rss():
+    """Peak resident set size of this process in bytes, or None where
+    the `resource` module is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes:
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def benchmark_recogs_dataset(enc_tokenizer, dec_tokenizer, X, y):
+    """Time the construction of a `RecogsDataset` for `X` and `y`
+    against the original per-string `encode` approach, and report the
+    memory retained by each (per `tracemalloc`) and the change in
+    resident memory.
+
+    Parameters
+    ----------
+    enc_tokenizer: `PreTrainedTokenizerFast`
+    dec_tokenizer: `PreTrainedTokenizerFast`
+    X: iterable of str
+    y: iterable of str
+
+    Returns
+    -------
+    dict mapping approach names to dicts of measurements
+    """
+    def per_string():
+        return ([enc_tokenizer.encode(s) for s in X],
+                [dec_tokenizer.encode(s) for s in y])
+    def batched():
+        return RecogsDataset(enc_tokenizer, dec_tokenizer, X, y=y)
+    results = {}
+    for name, build in (("per-string encode", per_string), ("RecogsDataset", batched)):
+        start = time.perf_counter()
+        data = build()
+        elapsed = time.perf_counter() - start
+        del data
+        # A second, traced build for the memory measurements, since
+        # `tracemalloc` slows things down considerably:
+        gc.collect()
+        rss_before = get_rss()
+        tracemalloc.start()
+        data = build()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = get_rss()
+        del data
+        results[name] = {
+            "seconds": elapsed,
+            "retained_mb": retained / 2**20,
+            "peak_mb": peak / 2**20}
+        if rss_before is not None:
+            results[name]["rss_delta_mb"] = (rss_after - rss_before) / 2**20
+        print(f"{name}: " + ", ".join(
+            f"{k}={v:.2f}" for k, v in results[name].items()))
+    return results
+
+# benchmark_recogs_dataset(
+#     enc_tokenizer, dec_tokenizer,
+#     dataset['train'].input, dataset['train'].output)
+
+"""Since `collate_fn` runs for every batch of every epoch, and in every call to `predict`, its overhead matters. This compares it with the original list-based version:"""
+
+def list_collate_fn(batch):
+    """The original list-based version of `RecogsDataset.collate_fn`,
+    kept as a reference for `benchmark_collate_fn`."""
+    def get_pad_and_mask(vals):
+        lens = [len(i) for i in vals]
+        maxlen = max(lens)
+        pad = []
+        mask = []
+        for ex, length in zip(vals, lens):
+            diff = maxlen - length
+            pad.append(list(ex) + ([0] * diff))
+            mask.append(([1] * length) + ([0] * diff))
+        return torch.tensor(pad), torch.tensor(mask)
+    batch_elements = list(zip(*batch))
+    X = batch_elements[0]
+    X_pad, X_mask = get_pad_and_mask(X)
+    if len(batch_elements) == 1:
+        return X_pad, X_mask
+    else:
+        y = batch_elements[1]
+        y_pad, y_mask = get_pad_and_mask(y)
+        return X_pad, X_mask, y_pad, y_mask, y_pad
+
+def benchmark_collate_fn(recogs_dataset, batch_size=32, n_batches=200):
+    """Per-batch latency of `RecogsDataset.collate_fn` against
+    `list_collate_fn`, on the same randomly sampled batches. The
+    original version gets its examples as lists of ints, as the
+    original `RecogsDataset` stored them.
+
+    Parameters
+    ----------
+    recogs_dataset: `RecogsDataset`
+    batch_size: int
+    n_batches: int
+
+    Returns
+    -------
+    dict mapping function names to mean seconds per batch
+    """
+    rng = np.random.default_rng(0)
+    batches = [
+        [recogs_dataset[i] for i in rng.integers(len(recogs_dataset), size=batch_size)]
+        for _ in range(n_batches)]
+    list_batches = [[tuple(list(x) for x in ex) for ex in batch] for batch in batches]
+    for old, new in zip(list_collate_fn(list_batches[0]), RecogsDataset.collate_fn(batches[0])):
+        if not torch.equal(old, new):
+            print("Error for `collate_fn`: batches differ from `list_collate_fn`")
+    timings = {}
+    for name, func, data in (
+            ("list_collate_fn", list_collate_fn, list_batches),
+            ("collate_fn", RecogsDataset.collate_fn, batches)):
+        start = time.perf_counter()
+        for batch in data:
+            func(batch)
+        timings[name] = (time.perf_counter() - start) / n_batches
+    baseline = timings["list_collate_fn"]
+    for name, secs in timings.items():
+        print(f"{name}: {secs * 1e6:.0f}us per batch ({baseline / secs:.1f}x)")
+    return timings
+
+# benchmark_collate_fn(
+#     RecogsDataset(
+#         enc_tokenizer, dec_tokenizer,
+#         dataset['train'].input, y=dataset['train'].output))
+
+"""Since `collate_fn` pads every batch to its longest member, batches that mix short and long sentences waste compute, and generation cost scales with the worst sequence in each batch. `LengthBucketBatchSampler` groups examples of similar length using the "sort within chunk" strategy: the data are (optionally) shuffled, cut into chunks of `batch_size * bucket_size_multiplier` examples, each chunk is sorted by length and cut into batches, and then the batch order is (optionally) shuffled. With `max_tokens`, the sorted chunks are instead packed into batches with a bounded number of padded tokens, so that short sentences get large batches and long ones small batches. `RecogsModel` uses it when `length_bucketing=True` or `max_tokens_per_batch` is given."""
+
+def padding_efficiency(batches, *lengths):
+    """Ratio of real tokens to padded tokens for `batches`.
+
+    Parameters
+    ----------
+    batches: iterable of lists of int
+        Indices into `lengths`.
+    lengths: one or more np.array of int
+        Per-example lengths for each padded field.
+
+    Returns
+    -------
+    float
+    """
+    real = 0
+    padded = 0
+    for batch in batches:
+        for field_lengths in lengths:
+            batch_lengths = field_lengths[batch]
+            real += batch_lengths.sum()
+            padded += len(batch) * batch_lengths.max()
+    return float(real / padded) if padded else 1.0
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """Batch sampler yielding lists of indices of similar-length
+    examples.
+
+    Parameters
+    ----------
+    lengths: list of np.array of int
+        Per-example lengths for each padded field, as given by
+        `RecogsDataset.lengths`. Examples are sorted by their summed
+        lengths.
+    batch_size: int
+        Examples per batch, unless `max_tokens` is given, in which case
+        this only determines the chunk size.
+    max_tokens: int or None
+        If given, batches are packed greedily, in sorted order, so that
+        each has at most this many padded tokens (summed over the
+        fields). A single example longer than this gets a batch of its
+        own.
+    shuffle: bool
+        Whether to shuffle the examples before chunking and the batches
+        after. A new arrangement is drawn for every epoch after the
+        first.
+    bucket_size_multiplier: int
+        Chunks are `batch_size * bucket_size_multiplier` examples.
+    seed: int or None
+
+    Attributes
+    ----------
+    batches: list of lists of int
+        The batches for the current epoch.
+    epoch_padding_efficiency: list of float
+        `padding_efficiency` of each epoch so far.
+    """
+    def __init__(self, lengths, batch_size, max_tokens=None, shuffle=False,
+            bucket_size_multiplier=50, seed=None):
+        self.lengths = [np.asarray(field_lengths) for field_lengths in lengths]
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.rng = np.random.default_rng(seed)
+        self.epoch_padding_efficiency = []
+        self._n_epochs = 0
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        sort_lengths = sum(self.lengths)
+        n = len(sort_lengths)
+        order = self.rng.permutation(n) if self.shuffle else np.arange(n)
+        chunksize = self.batch_size * self.bucket_size_multiplier
+        batches = []
+        for start in range(0, n, chunksize):
+            chunk = order[start: start + chunksize]
+            chunk = chunk[np.argsort(sort_lengths[chunk], kind="stable")]
+            batches += self._split_chunk(chunk)
+        if self.shuffle:
+            batches = [batches[i] for i in self.rng.permutation(len(batches))]
+        return batches
+
+    def _split_chunk(self, chunk):
+        if self.max_tokens is None:
+            return [
+                chunk[i: i + self.batch_size].tolist()
+                for i in range(0, len(chunk), self.batch_size)]
+        chunk = chunk.tolist()
+        chunk_lengths = list(zip(*[
+            field_lengths[chunk].tolist() for field_lengths in self.lengths]))
+        batches = []
+        batch = []
+        batch_maxes = None
+        for i, example_lengths in zip(chunk, chunk_lengths):
+            if batch_maxes is None:
+                new_maxes = example_lengths
+            else:
+                new_maxes = tuple(map(max, batch_maxes, example_lengths))
+            if batch and (len(batch) + 1) * sum(new_maxes) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                new_maxes = example_lengths
+            batch.append(i)
+            batch_maxes = new_maxes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @property
+    def mean_batch_size(self):
+        return sum(map(len, self.batches)) / max(len(self.batches), 1)
+
+    @property
+    def padding_efficiency(self):
+        return padding_efficiency(self.batches, *self.lengths)
+
+    def __iter__(self):
+        if self.shuffle and self._n_epochs > 0:
+            self.batches = self._make_batches()
+        self._n_epochs += 1
+        self.epoch_padding_efficiency.append(self.padding_efficiency)
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
 """The following just illustrate how to work with the above utility:"""
 
-ex_dataset = RecogsDataset(
-    enc_tokenizer,
-    dec_tokenizer,
-    dataset['train'].input.head(20),
-    y=dataset['train'].output.head(20))
+if __name__ == "__main__":
+    ex_dataset = RecogsDataset(
+        enc_tokenizer,
+        dec_tokenizer,
+        dataset['train'].input.head(20),
+        y=dataset['train'].output.head(20))
 
-ex_dataloader = torch.utils.data.DataLoader(
-    ex_dataset,
-    batch_size=2,
-    shuffle=True,
-    pin_memory=True,
-    collate_fn=ex_dataset.collate_fn)
+    ex_dataloader = torch.utils.data.DataLoader(
+        ex_dataset,
+        batch_size=2,
+        shuffle=True,
+        pin_memory=True,
+        collate_fn=ex_dataset.collate_fn)
 
-ex_batch = iter(ex_dataloader)
+    ex_batch = iter(ex_dataloader)
 
 """This will show you batches. Since `batch_size=2` for `dataloader`, this will be a tuple where each element has two lists. The structure is determined by `collate_fn` in `RecogsDataset`: 
 
@@ -409,54 +1580,59 @@ ex_batch = iter(ex_dataloader)
 where `y_pad` is repeated in the final position to meet the interface specifications of `torch_base_model.py`, in case you decide to train models yourself. (See details below; Hugging Face calculates the loss itself, which is ultimately nice but a bit non-standard.)
 """
 
-next(ex_batch)
+if __name__ == "__main__":
+    next(ex_batch)
 
 """### Model basics
 
 Now we come to the model itself. We will first load it and explore it a bit, and then we will define a nice classifier interface for it.
 """
 
-from transformers import EncoderDecoderModel
+@functools.lru_cache(maxsize=None)
+def get_encdec():
+    from transformers import EncoderDecoderModel
+    return EncoderDecoderModel.from_pretrained(f"ReCOGS/ReCOGS-model")
 
-encdec = EncoderDecoderModel.from_pretrained(f"ReCOGS/ReCOGS-model")
+if __name__ == "__main__":
+    encdec = get_encdec()
 
-"""A single illustrative example:"""
+    """A single illustrative example:"""
 
-ex_inputs = enc_tokenizer.batch_encode_plus(
-    ["A rose was helped by a dog ."], 
-    return_tensors='pt')
+    ex_inputs = enc_tokenizer.batch_encode_plus(
+        ["A rose was helped by a dog ."], 
+        return_tensors='pt')
 
-ex_outputs = dec_tokenizer.batch_encode_plus(
-    ['rose ( 53 ) ; dog ( 38 ) ; help ( 7 ) AND theme ( 7 , 53 ) AND agent ( 7 , 38 )'], 
-    return_tensors='pt')
+    ex_outputs = dec_tokenizer.batch_encode_plus(
+        ['rose ( 53 ) ; dog ( 38 ) ; help ( 7 ) AND theme ( 7 , 53 ) AND agent ( 7 , 38 )'], 
+        return_tensors='pt')
 
-"""Here is the forward method. For training, it is vital to have `labels=` here so that the model return a loss value."""
+    """Here is the forward method. For training, it is vital to have `labels=` here so that the model return a loss value."""
 
-ex_rep = encdec(
-    ex_inputs['input_ids'],
-    ex_inputs['attention_mask'],
-    ex_outputs['input_ids'],
-    labels=ex_outputs['attention_mask'])
+    ex_rep = encdec(
+        ex_inputs['input_ids'],
+        ex_inputs['attention_mask'],
+        ex_outputs['input_ids'],
+        labels=ex_outputs['attention_mask'])
 
-ex_rep.keys()
+    ex_rep.keys()
 
-"""And here is how we will do generation:"""
+    """And here is how we will do generation:"""
 
-ex_gen = encdec.generate(
-    ex_inputs['input_ids'],
-    attention_mask=ex_inputs['attention_mask'],
-    max_new_tokens=512,
-    eos_token_id=encdec.config.eos_token_id)
+    ex_gen = encdec.generate(
+        ex_inputs['input_ids'],
+        attention_mask=ex_inputs['attention_mask'],
+        max_new_tokens=512,
+        eos_token_id=encdec.config.eos_token_id)
 
-ex_gen
+    ex_gen
 
-ex_pred = dec_tokenizer.batch_decode(
-    ex_gen, 
-    skip_special_tokens=False, 
-    # Out tokenizer have this set already, but I am nervous:
-    clean_up_tokenization_spaces=False)
+    ex_pred = dec_tokenizer.batch_decode(
+        ex_gen, 
+        skip_special_tokens=False, 
+        # Out tokenizer have this set already, but I am nervous:
+        clean_up_tokenization_spaces=False)
 
-ex_pred
+    ex_pred
 
 """### Model interface
 
@@ -465,7 +1641,6 @@ Okay, finally, the main interface. If you do not plan to train your own models u
 
 from torch_model_base import TorchModelBase
 import torch.nn as nn
-from transformers import EncoderDecoderModel
 
 """As I mentioned above, Hugging Face `EncoderDecoderModel` instances will calculate a loss internally if you provide them with `labels`. Normally, one's optimization loop would need to do this manually. In order to rely on Hugging Face and still use the trainer in `torch_model_base.py`, we define this simple loss that just takes in model outputs and labels and returns `outputs.loss`. The labels argument is present for compatibility; it was already used internally to get the value of `outputs.loss` and so can be ignored."""
 
@@ -479,22 +1654,571 @@ class RecogsLoss(nn.Module):
         value of `outputs.loss`, and that value is all we need."""
         return outputs.loss
 
-"""Here is a basic `nn.Module`. Its sole purpose is to organize the examples created by our `RecogsDataset` and feed them to the trained `EncoderDecoderModel`:"""
+"""Here is a basic `nn.Module`. Its sole purpose is to organize the examples created by our `RecogsDataset` and feed them to the trained `EncoderDecoderModel`. Its `precision` is set by `RecogsModel`; with "bf16", the forward pass runs under autocast, while the weights (and so the optimizer state) stay in fp32:"""
+
+def get_autocast(device_type, precision):
+    """Autocast context for `precision`, which is "fp32" (no autocast)
+    or "bf16"."""
+    return torch.autocast(
+        device_type=device_type,
+        dtype=torch.bfloat16,
+        enabled=precision == "bf16")
 
 class RecogsModule(nn.Module):
-    def __init__(self):
+    precision = "fp32"
+
+    def __init__(self, config=None):
+        """With a `config`, the model is built from it, with fresh
+        weights, rather than downloaded; `RecogsModel.load` uses this."""
         super().__init__()
-        self.encdec = EncoderDecoderModel.from_pretrained(
-            f"ReCOGS/ReCOGS-model")
+        from transformers import EncoderDecoderModel
+        if config is None:
+            self.encdec = EncoderDecoderModel.from_pretrained(
+                f"ReCOGS/ReCOGS-model")
+        else:
+            self.encdec = EncoderDecoderModel(config=config)
 
     def forward(self, X_pad, X_mask, y_pad, y_mask, labels=None):
-        outputs = self.encdec(
-            input_ids=X_pad, 
-            attention_mask=X_mask,
-            decoder_attention_mask=y_mask,
-            labels=y_pad)
+        with get_autocast(X_pad.device.type, self.precision):
+            outputs = self.encdec(
+                input_ids=X_pad, 
+                attention_mask=X_mask,
+                decoder_attention_mask=y_mask,
+                labels=y_pad)
         return outputs
 
+"""For long runs, like the full gen split, `RecogsModel.predict_iter` yields predictions batch by batch. Given a `PredictionSink`, it also appends each batch to a JSONL or TSV file as it finishes, and skips examples already recorded there, so an interrupted run can be resumed by simply calling it again with the same sink."""
+
+import collections
+import copy
+import csv
+import importlib
+import json
+
+class PredictionSink:
+    """Append-only record of predictions in `filename`, one line per
+    example, with the example's position in the input sequence, the
+    input, and the prediction. Files ending in ".jsonl" are written as
+    JSON lines, anything else as TSV.
+
+    Parameters
+    ----------
+    filename: str
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.jsonl = filename.endswith(".jsonl")
+
+    def read(self, X=None):
+        """Map from positions to predictions for every example recorded
+        so far. If `X` is given, check that the recorded inputs match
+        it, to avoid resuming a run on different data.
+
+        Parameters
+        ----------
+        X: list of str or None
+
+        Returns
+        -------
+        dict
+        """
+        preds = {}
+        if not os.path.exists(self.filename):
+            return preds
+        with open(self.filename, newline="") as f:
+            if self.jsonl:
+                records = (json.loads(line) for line in f if line.strip())
+                records = ((r["index"], r["input"], r["prediction"]) for r in records)
+            else:
+                records = csv.reader(f, delimiter="\t")
+            for index, ex, pred in records:
+                index = int(index)
+                if X is not None and (index >= len(X) or X[index] != ex):
+                    raise ValueError(
+                        f"{self.filename} does not match the inputs at "
+                        f"position {index}; use a new sink for new inputs.")
+                preds[index] = pred
+        return preds
+
+    def write(self, indices, X, preds):
+        with open(self.filename, "a", newline="") as f:
+            if self.jsonl:
+                for index, ex, pred in zip(indices, X, preds):
+                    record = {"index": index, "input": ex, "prediction": pred}
+                    f.write(json.dumps(record) + "\n")
+            else:
+                # Fields with tabs, quotes, or newlines are quoted:
+                writer = csv.writer(f, delimiter="\t")
+                writer.writerows(zip(indices, X, preds))
+
+def collect_predictions(model, X, sink=None):
+    """Predictions for `X` in order, via `model.predict_iter` where
+    the model has one (so that `sink` is used), else `model.predict`.
+
+    Parameters
+    ----------
+    model: `RecogsModel` or any object with a `predict` method
+    X: iterable of str
+    sink: `PredictionSink` or None
+
+    Returns
+    -------
+    list of str
+    """
+    if not hasattr(model, "predict_iter"):
+        return model.predict(X)
+    X = list(X)
+    preds = [None] * len(X)
+    for indices, results in model.predict_iter(X, sink=sink):
+        for i, result in zip(indices, results):
+            preds[i] = result
+    return preds
+
+def test_prediction_sink(dirname="."):
+    """Round-trip awkward strings through JSONL and TSV sinks in
+    `dirname`."""
+    X = ['A "quoted" input .', "A\ttabbed input .", "A two-line\ninput .", "Plain ."]
+    preds = ['x ( 1 ) ; " ( 2 )', "\t", "\n\r", ""]
+    errcount = 0
+    for suffix in ("jsonl", "tsv"):
+        filename = os.path.join(dirname, f"test_prediction_sink.{suffix}")
+        if os.path.exists(filename):
+            os.remove(filename)
+        try:
+            sink = PredictionSink(filename)
+            sink.write([0, 1], X[: 2], preds[: 2])
+            sink.write([2, 3], X[2: ], preds[2: ])
+            result = sink.read(X)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+        if result != dict(enumerate(preds)):
+            errcount += 1
+            print(f"Error for {suffix}: expected {preds}, got {result}")
+    if errcount == 0:
+        print("No errors found for `PredictionSink`")
+
+# test_prediction_sink()
+
+"""`test_gen_acc`, `category_assess`, `score`, and the bakeoff step can end up predicting the same inputs with the same model many times over, and the gen and bakeoff splits contain repeated sentences. `RecogsModel.predict_iter` always predicts each distinct input only once per call. With a `PredictionCache`, it also remembers predictions across calls, keyed by the model's `fingerprint` (a hash of its weights and generation settings) and the input string, so that repeated assessment of the same model decodes each input only once."""
+
+import sqlite3
+
+class PredictionCache:
+    """Content-addressed cache of predictions: an in-memory LRU backed
+    by an optional SQLite file.
+
+    Parameters
+    ----------
+    filename: str or None
+        SQLite database for persistent storage. If None, the cache
+        lives only in memory.
+    maxsize: int
+        Maximum number of entries kept in memory.
+    """
+    def __init__(self, filename=None, maxsize=100000):
+        self.filename = filename
+        self.maxsize = maxsize
+        self.memory = collections.OrderedDict()
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None and self.filename is not None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "fingerprint TEXT, input TEXT, prediction TEXT, "
+                "PRIMARY KEY (fingerprint, input))")
+        return self._connection
+
+    def _remember(self, key, pred):
+        self.memory[key] = pred
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def get_many(self, fingerprint, X):
+        """Map from members of `X` to their cached predictions, for the
+        members that have one."""
+        found = {}
+        missing = []
+        for ex in X:
+            key = (fingerprint, ex)
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[ex] = self.memory[key]
+            else:
+                missing.append(ex)
+        if self.connection is not None:
+            # Stay well below SQLite's limit on query parameters:
+            for start in range(0, len(missing), 500):
+                chunk = missing[start: start + 500]
+                rows = self.connection.execute(
+                    "SELECT input, prediction FROM predictions "
+                    "WHERE fingerprint = ? AND input IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    [fingerprint] + chunk)
+                for ex, pred in rows:
+                    found[ex] = pred
+                    self._remember((fingerprint, ex), pred)
+        return found
+
+    def put_many(self, fingerprint, X, preds):
+        for ex, pred in zip(X, preds):
+            self._remember((fingerprint, ex), pred)
+        if self.connection is not None:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                    [(fingerprint, ex, pred) for ex, pred in zip(X, preds)])
+
+"""`StageStats` collects wall time, call counts, and token counts for named stages of `fit` and `predict`, as well as the peak RSS. Each `RecogsModel` has one as `stats`, which does nothing unless it is enabled with `instrument=True` (or by setting `stats.enabled`). The stages are:
+
+* `tokenize`: `build_dataset`
+* `collate`: `collate_fn`
+* `to_device`: host-to-device copies in `predict`
+* `forward`: the module's forward pass in `fit`
+* `fit`: all of `fit`
+* `decode`: `generate` or `greedy_decode`, counting generated tokens
+* `batch_decode`: detokenization
+* `score`: exact-match scoring in `category_assess` and `evaluate_categories`
+* `template`: `TemplateIndex` lookups
+
+`RecogsModel.profile` also exports a `torch.profiler` trace for a number of `predict` batches, with these stages marked in it."""
+
+import contextlib
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+class _ForwardTimer:
+    # Hooks are methods of this class, rather than closures, so that
+    # modules with them attached can still be pickled:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def pre_hook(self, module, args):
+        if self.stats.enabled:
+            self.stats._starts[self.name] = time.perf_counter()
+
+    def hook(self, module, args, output):
+        if self.stats.enabled and self.name in self.stats._starts:
+            start = self.stats._starts.pop(self.name)
+            self.stats._record(self.name, time.perf_counter() - start)
+
+class StageStats:
+    """Per-stage timing for `RecogsModel`.
+
+    Parameters
+    ----------
+    enabled: bool
+        When False, `stage` returns a shared no-op context manager and
+        nothing is recorded.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # Set by `RecogsModel.profile` to mark stages in the trace:
+        self.profiling = False
+        self.reset()
+
+    def reset(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.Counter()
+        self.tokens = collections.Counter()
+        self.peak_rss = None
+        self._starts = {}
+
+    def stage(self, name):
+        """Context manager timing one call to stage `name`."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        with contextlib.ExitStack() as stack:
+            if self.profiling:
+                stack.enter_context(torch.profiler.record_function(name))
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._record(name, time.perf_counter() - start)
+
+    def _record(self, name, seconds):
+        self.seconds[name] += seconds
+        self.calls[name] += 1
+        peak_rss = get_peak_rss()
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+
+    def add_tokens(self, name, n_tokens):
+        if self.enabled:
+            self.tokens[name] += int(n_tokens)
+
+    def wrap(self, name, func):
+        """`func`, timed as stage `name` when enabled."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def attach(self, module, name="forward"):
+        """Time the forward pass of `module` as stage `name`. The hooks
+        return immediately when this object is disabled."""
+        timer = _ForwardTimer(self, name)
+        return [
+            module.register_forward_pre_hook(timer.pre_hook),
+            module.register_forward_hook(timer.hook)]
+
+    def summary(self):
+        """`pd.DataFrame` with a row per stage, in descending order of
+        total time."""
+        summary_df = pd.DataFrame({
+            "calls": pd.Series(self.calls, dtype=int),
+            "seconds": pd.Series(self.seconds, dtype=float),
+            "tokens": pd.Series(self.tokens, dtype=int)})
+        summary_df.index.name = "stage"
+        summary_df["tokens"] = summary_df.tokens.fillna(0).astype(int)
+        summary_df["ms_per_call"] = 1000 * summary_df.seconds / summary_df.calls
+        summary_df["tokens_per_second"] = (
+            summary_df.tokens / summary_df.seconds).where(summary_df.tokens > 0)
+        return summary_df.sort_values("seconds", ascending=False)
+
+    def __repr__(self):
+        peak_rss = "n/a" if self.peak_rss is None else f"{self.peak_rss / 1e6:.1f}MB"
+        return f"{self.summary().to_string()}\npeak RSS: {peak_rss}"
+
+"""`RecogsModel` normally decodes with `generate`. `greedy_decode` is an equivalent, instrumented greedy decoder for `RecogsModule` and `T5BaseRecogsModule`. It runs the encoder once per batch, feeds the decoder one token per step while reusing its self- and cross-attention caches, and removes sequences from the active batch (and the caches) as soon as they emit [EOS]. With `step_times`, it records the active batch size and the time taken for each step."""
+
+def _select_cache_rows(past_key_values, rows):
+    """Keep only `rows` of the batch in `past_key_values`, which is
+    either a transformers `Cache` or a legacy tuple of per-layer
+    tuples of tensors."""
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(rows)
+        return past_key_values
+    return tuple(
+        tuple(tensor[rows] for tensor in layer)
+        for layer in past_key_values)
+
+def greedy_decode(encdec, input_ids, attention_mask, max_new_tokens,
+        eos_token_id, pad_token_id, decoder_start_token_id=None,
+        step_times=None):
+    """Greedy decoding with the same output as `encdec.generate` with
+    default (greedy) settings.
+
+    Parameters
+    ----------
+    encdec: `EncoderDecoderModel` or `T5ForConditionalGeneration`
+    input_ids: torch.LongTensor
+    attention_mask: torch.LongTensor
+    max_new_tokens: int
+    eos_token_id: int
+    pad_token_id: int
+        Fills the positions after [EOS].
+    decoder_start_token_id: int or None
+        Default: `encdec.config.decoder_start_token_id`.
+    step_times: list or None
+        If given, a `(active_batch_size, seconds)` pair is appended for
+        every decoding step.
+
+    Returns
+    -------
+    torch.LongTensor
+        Decoder start token followed by the generated tokens
+    """
+    if decoder_start_token_id is None:
+        decoder_start_token_id = encdec.config.decoder_start_token_id
+    batch_size = input_ids.shape[0]
+    device = input_ids.device
+    outputs = torch.full(
+        (batch_size, max_new_tokens + 1), pad_token_id,
+        dtype=torch.long, device=device)
+    outputs[:, 0] = decoder_start_token_id
+    encoder_outputs = encdec.get_encoder()(
+        input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+    active = torch.arange(batch_size, device=device)
+    next_tokens = outputs[:, : 1]
+    past_key_values = None
+    n_steps = 0
+    while n_steps < max_new_tokens and len(active):
+        start = time.perf_counter()
+        active_batch_size = len(active)
+        step_outputs = encdec(
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            decoder_input_ids=next_tokens,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True)
+        tokens = step_outputs.logits[:, -1].argmax(dim=-1)
+        n_steps += 1
+        outputs[active, n_steps] = tokens
+        past_key_values = step_outputs.past_key_values
+        unfinished = tokens != eos_token_id
+        if not unfinished.all():
+            rows = unfinished.nonzero().squeeze(1)
+            active = active[rows]
+            tokens = tokens[rows]
+            attention_mask = attention_mask[rows]
+            encoder_outputs.last_hidden_state = (
+                encoder_outputs.last_hidden_state[rows])
+            if len(active):
+                past_key_values = _select_cache_rows(past_key_values, rows)
+        next_tokens = tokens.unsqueeze(1)
+        if step_times is not None:
+            step_times.append(
+                (active_batch_size, time.perf_counter() - start))
+    return outputs[:, : n_steps + 1]
+
+"""ReCOGS sentences come from a small grammar, so many inputs differ from a train example only in their nouns and proper names. `TemplateIndex` is built from the train split alone. It learns which words are nouns and names (the words that appear in LFs as one-place predicates of entities), maps each delexicalized input skeleton to an LF template with numbered slots, and fills those slots for new inputs with the same skeleton. Verbs stay in the skeleton, since their LF lemmas differ from their inflected forms and their class determines the roles. A skeleton whose train examples disagree about the template (up to variable names and conjunct order) is left out. Given a `template_index`, `RecogsModel.predict` answers hits directly and decodes only the misses."""
+
+TEMPLATE_EVENT_ROLES = frozenset(["agent", "theme", "recipient", "ccomp", "xcomp"])
+
+def _lf_predicates(tokens):
+    """The one-place predicates in the tokenized LF `tokens`, as
+    `(position, word, variable)` triples, and the set of event
+    variables (the first arguments of role predicates)."""
+    predicates = []
+    events = set()
+    for j in range(len(tokens) - 3):
+        if tokens[j + 1] != "(" or not tokens[j + 2].isdigit():
+            continue
+        if tokens[j + 3] == ")":
+            predicates.append((j, tokens[j], tokens[j + 2]))
+        elif tokens[j + 3] == "," and tokens[j] in TEMPLATE_EVENT_ROLES:
+            events.add(tokens[j + 2])
+    return predicates, events
+
+class TemplateIndex:
+    """Map from delexicalized input skeletons to LF templates.
+
+    Parameters
+    ----------
+    lexicon: dict
+        Maps slot words to their class, "NAME" or "NOUN".
+    templates: dict
+        Maps skeletons to LF templates, in which slot `i` of the
+        skeleton is written `<i>`.
+    """
+    def __init__(self, lexicon, templates):
+        self.lexicon = lexicon
+        self.templates = templates
+        self._fingerprint = None
+
+    @classmethod
+    def from_split(cls, split_df):
+        """Build an index from `split_df`, which must contain only
+        "in_distribution" examples, like `dataset['train']`, so that
+        nothing is ever learned from the gen split.
+
+        Returns
+        -------
+        `TemplateIndex`
+        """
+        categories = set(split_df.category.unique())
+        if categories - {"in_distribution"}:
+            raise ValueError(
+                "Template indices can only be built from in-distribution "
+                f"examples (like `dataset['train']`), not {sorted(categories)}.")
+        lfs = [lf.split() for lf in split_df.output]
+        entity_words = set()
+        event_words = set()
+        for tokens in lfs:
+            predicates, events = _lf_predicates(tokens)
+            for _, word, var in predicates:
+                (event_words if var in events else entity_words).add(word)
+        lexicon = {
+            word: "NAME" if word[: 1].isupper() else "NOUN"
+            for word in entity_words - event_words}
+        index = cls(lexicon, {})
+        candidates = {}
+        for text, tokens in zip(split_df.input, lfs):
+            skeleton, slots = index.delexicalize(text)
+            template = cls._make_template(tokens, slots)
+            if template is None:
+                continue
+            candidates.setdefault(skeleton, {}).setdefault(
+                canonical_lf(template), template)
+        index.templates = {
+            skeleton: next(iter(templates.values()))
+            for skeleton, templates in candidates.items()
+            if len(templates) == 1}
+        return index
+
+    @staticmethod
+    def _make_template(tokens, slots):
+        """Replace the predicate for each slot word with its slot
+        number, or return None if that is ambiguous."""
+        if len(set(slots)) != len(slots):
+            return None
+        tokens = list(tokens)
+        predicates, _ = _lf_predicates(tokens)
+        positions = {}
+        for j, word, _ in predicates:
+            positions.setdefault(word, []).append(j)
+        for i, word in enumerate(slots):
+            if len(positions.get(word, [])) != 1 or tokens.count(word) != 1:
+                return None
+            tokens[positions[word][0]] = f"<{i}>"
+        return " ".join(tokens)
+
+    def delexicalize(self, text):
+        """The skeleton of `text` and its slot words, in order."""
+        skeleton = []
+        slots = []
+        for token in text.split():
+            slot_class = self.lexicon.get(token)
+            if slot_class is None:
+                skeleton.append(token)
+            else:
+                skeleton.append(slot_class)
+                slots.append(token)
+        return " ".join(skeleton), slots
+
+    def predict(self, text):
+        """The LF for `text`, or None if its skeleton is not indexed."""
+        skeleton, slots = self.delexicalize(text)
+        template = self.templates.get(skeleton)
+        if template is None:
+            return None
+        slot_values = {f"<{i}>": word for i, word in enumerate(slots)}
+        return " ".join(slot_values.get(tok, tok) for tok in template.split())
+
+    def predict_many(self, X):
+        """Map from the members of `X` that are hits to their LFs."""
+        hits = {}
+        for text in X:
+            pred = self.predict(text)
+            if pred is not None:
+                hits[text] = pred
+        return hits
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(json.dumps(
+                [self.lexicon, self.templates], sort_keys=True).encode("utf8")
+            ).hexdigest()
+        return self._fingerprint
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"lexicon": self.lexicon, "templates": self.templates}, f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(data["lexicon"], data["templates"])
+
+    def __len__(self):
+        return len(self.templates)
+
+# template_index = TemplateIndex.from_split(dataset['train'])
+
 """And, at last, our interface. The keyword parameter `initialize=True` is the default because we are initially going to use this just for making predictions, and so we need the instance to establish all its parameters when we initialize it as opposed to waiting to do that when we call `fit` (which we may never do)."""
 
 class RecogsModel(TorchModelBase):
@@ -502,56 +2226,1029 @@ class RecogsModel(TorchModelBase):
             initialize=True,
             enc_vocab_filename=f"{SRC_DIRNAME}/src_vocab.txt",
             dec_vocab_filename=f"{SRC_DIRNAME}/tgt_vocab.txt",
+            token_cache_dirname=TOKEN_CACHE_DIRNAME,
+            length_bucketing=False,
+            bucket_size_multiplier=50,
+            max_tokens_per_batch=None,
+            max_new_tokens=512,
+            adaptive_max_new_tokens=False,
+            generation_length_margin=1.25,
+            prediction_cache=None,
+            quantize=None,
+            decoder="generate",
+            precision="fp32",
+            instrument=False,
+            template_index=None,
             **kwargs):
         self.enc_vocab_filename = enc_vocab_filename
         self.dec_vocab_filename = dec_vocab_filename
         self.enc_tokenizer = get_tokenizer(self.enc_vocab_filename)
         self.dec_tokenizer = get_tokenizer(self.dec_vocab_filename)
+        # Inputs cached with `pretokenize_split` are not re-tokenized
+        # by `build_dataset`. Use `None` to turn this off:
+        self.token_cache_dirname = token_cache_dirname
+        self.token_cache = None
+        if token_cache_dirname is not None:
+            self.token_cache = TokenCache(token_cache_dirname)
+        # Batch similar-length examples together in `fit` and `predict`
+        # (see `LengthBucketBatchSampler`):
+        self.length_bucketing = length_bucketing
+        self.bucket_size_multiplier = bucket_size_multiplier
+        # Pack batches by padded token count rather than using a fixed
+        # `batch_size`. The count is input plus output tokens in both
+        # `fit` and `predict`; in `predict`, each example's output is
+        # counted at its generation cap (see `_get_output_length_caps`).
+        # In `fit`, `gradient_accumulation_steps` is scaled so that an
+        # optimizer step still covers about `batch_size *
+        # gradient_accumulation_steps` examples:
+        self.max_tokens_per_batch = max_tokens_per_batch
+        # With `adaptive_max_new_tokens=True`, the generation cap for a
+        # batch is derived from its longest input, using the largest
+        # output/input length ratio in the training data (see
+        # `set_generation_length_ratio`) times `generation_length_margin`.
+        # `max_new_tokens` is always an upper limit:
+        self.max_new_tokens = max_new_tokens
+        self.adaptive_max_new_tokens = adaptive_max_new_tokens
+        self.generation_length_margin = generation_length_margin
+        self.generation_length_ratio = None
+        # A `PredictionCache` shared by every call to `predict`:
+        self.prediction_cache = prediction_cache
+        self._weights_hash = None
+        # With `quantize="int8"`, `predict` uses a copy of the model with
+        # dynamically quantized `nn.Linear` layers (CPU only). The copy
+        # is made on first use and discarded after every optimizer step:
+        if quantize not in (None, "int8"):
+            raise ValueError(
+                f"Unsupported value for `quantize`: {quantize!r}; "
+                "use None or 'int8'.")
+        self.quantize = quantize
+        self._quantized_model = None
+        # "generate" uses `encdec.generate`; "greedy" uses `greedy_decode`,
+        # which gives the same predictions:
+        if decoder not in ("generate", "greedy"):
+            raise ValueError(
+                f"Unsupported value for `decoder`: {decoder!r}; "
+                "use 'generate' or 'greedy'.")
+        self.decoder = decoder
+        # With "bf16", the forward pass in `fit` and decoding in `predict`
+        # run under CPU (or CUDA) autocast; the weights stay in fp32:
+        if precision not in ("fp32", "bf16"):
+            raise ValueError(
+                f"Unsupported value for `precision`: {precision!r}; "
+                "use 'fp32' or 'bf16'.")
+        self.precision = precision
+        # Per-stage timing; see `StageStats`:
+        self.stats = StageStats(enabled=instrument)
+        # A `TemplateIndex` built from the train split; its hits are
+        # answered without decoding:
+        self.template_index = template_index
+        # Set by `load`; the weights are read on first use of `model`,
+        # into a graph built from the saved `transformers` config:
+        self._checkpoint = None
+        self._encdec_config = None
         super().__init__(*args, **kwargs)
+        self.params += [
+            'length_bucketing', 'bucket_size_multiplier', 'max_tokens_per_batch',
+            'max_new_tokens', 'adaptive_max_new_tokens',
+            'generation_length_margin', 'quantize', 'decoder', 'precision']
         self.loss = RecogsLoss()
+        # Real tokens over padded tokens, for the latest call to `fit`
+        # (averaged over epochs, with `length_bucketing=True`) and
+        # `predict`:
+        self.padding_efficiency = {}
+        # Counts for the latest call to `predict`: sequences generated,
+        # sequences stopped by the generation cap without emitting
+        # [EOS], and decoding steps run:
+        self.generation_stats = {}
         if initialize:
             self.initialize()
 
     def build_graph(self):
-        return RecogsModule()
+        return RecogsModule(config=self._encdec_config)
 
     def build_dataset(self, X, y=None):
-        return RecogsDataset(
-            self.enc_tokenizer, self.dec_tokenizer, X, y=y)
+        with self.stats.stage("tokenize"):
+            dataset = RecogsDataset(
+                self.enc_tokenizer, self.dec_tokenizer, X, y=y,
+                token_cache=self.token_cache)
+        if self.stats.enabled:
+            self.stats.add_tokens(
+                "tokenize", sum(int(lengths.sum()) for lengths in dataset.lengths))
+        return dataset
+
+    def _build_dataloader(self, dataset, shuffle=True):
+        uses_ratio = (
+            self.adaptive_max_new_tokens or self.max_tokens_per_batch is not None)
+        if shuffle and uses_ratio and len(dataset.lengths) == 2:
+            # This is the training data for `fit`, already tokenized:
+            self._set_generation_length_ratio(dataset)
+        dataloader = self._build_batched_dataloader(dataset, shuffle=shuffle)
+        if self.stats.enabled:
+            dataloader.collate_fn = self.stats.wrap("collate", dataloader.collate_fn)
+        return dataloader
+
+    def _build_batched_dataloader(self, dataset, shuffle=True):
+        if not self.length_bucketing and self.max_tokens_per_batch is None:
+            return super()._build_dataloader(dataset, shuffle=shuffle)
+        lengths = dataset.lengths
+        if self.max_tokens_per_batch is not None and len(lengths) == 1:
+            # `predict`: budget for the outputs too, as `fit` does:
+            lengths = lengths + [self._get_output_length_caps(lengths[0])]
+        batch_sampler = LengthBucketBatchSampler(
+            lengths,
+            self.batch_size,
+            max_tokens=self.max_tokens_per_batch,
+            shuffle=shuffle,
+            bucket_size_multiplier=self.bucket_size_multiplier)
+        if shuffle:
+            self._fit_batch_sampler = batch_sampler
+            if self.max_tokens_per_batch is not None:
+                # `fit` restores the original value when it is done:
+                target = self.batch_size * self.gradient_accumulation_steps
+                self.gradient_accumulation_steps = max(
+                    1, round(target / batch_sampler.mean_batch_size))
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_sampler=batch_sampler,
+            pin_memory=True,
+            collate_fn=dataset.collate_fn)
+
+    def set_generation_length_ratio(self, X, y):
+        """Learn the largest output/input token length ratio from the
+        pairs `(X, y)`, for use with `adaptive_max_new_tokens=True`.
+        `fit` does this with its training data (minus any early-stopping
+        validation examples) when `adaptive_max_new_tokens=True` or
+        `max_tokens_per_batch` is given, reusing the dataset it builds
+        anyway. For pretrained models,
+        call it with the train split -- never with `dataset['gen']`.
+
+        Parameters
+        ----------
+        X: iterable of str
+        y: iterable of str
+
+        Returns
+        -------
+        float
+        """
+        return self._set_generation_length_ratio(self.build_dataset(X, y))
+
+    def _set_generation_length_ratio(self, dataset):
+        X_lengths, y_lengths = dataset.lengths
+        self.generation_length_ratio = float(np.max(y_lengths / X_lengths))
+        return self.generation_length_ratio
+
+    def _get_max_new_tokens(self, X_mask):
+        if not self.adaptive_max_new_tokens:
+            return self.max_new_tokens
+        if self.generation_length_ratio is None:
+            raise ValueError(
+                "`adaptive_max_new_tokens=True` requires a length ratio "
+                "from `fit` or `set_generation_length_ratio`.")
+        max_input_length = int(X_mask.sum(dim=1).max())
+        cap = math.ceil(
+            max_input_length
+            * self.generation_length_ratio
+            * self.generation_length_margin)
+        return min(cap, self.max_new_tokens)
+
+    def _get_output_length_caps(self, X_lengths):
+        """Per-example generation caps for inputs of `X_lengths` tokens:
+        as in `_get_max_new_tokens` where a length ratio is known, else
+        `max_new_tokens`. Used to count output tokens against
+        `max_tokens_per_batch` in `predict`."""
+        X_lengths = np.asarray(X_lengths)
+        if self.generation_length_ratio is None:
+            return np.full_like(X_lengths, self.max_new_tokens)
+        caps = np.ceil(
+            X_lengths
+            * self.generation_length_ratio
+            * self.generation_length_margin).astype(X_lengths.dtype)
+        return np.minimum(caps, self.max_new_tokens)
+
+    def _update_generation_stats(self, outputs, max_new_tokens):
+        # Drop the decoder start token:
+        generated = outputs[:, 1: ]
+        eos_token_id = self.model.encdec.config.eos_token_id
+        unfinished = ~(generated == eos_token_id).any(dim=1)
+        cap_hits = 0
+        if generated.shape[1] >= max_new_tokens:
+            cap_hits = int(unfinished.sum())
+        self.generation_stats["sequences"] += outputs.shape[0]
+        self.generation_stats["cap_hits"] += cap_hits
+        self.generation_stats["decode_steps"] += generated.shape[1]
+        if self.stats.enabled:
+            pad_token_id = self.model.encdec.config.pad_token_id
+            self.stats.add_tokens("decode", (generated != pad_token_id).sum())
+
+    def initialize(self):
+        super().initialize()
+        self._setup_graph()
+
+    def _setup_graph(self):
+        self._invalidate_weights()
+        self.model.precision = self.precision
+        self.stats.attach(self.model, "forward")
+
+    def build_optimizer(self):
+        optimizer = super().build_optimizer()
+        # With early stopping, `fit` calls `score` after every epoch, so
+        # nothing derived from the weights may outlive an optimizer step:
+        optimizer.register_step_post_hook(self._invalidate_weights)
+        return optimizer
+
+    def _invalidate_weights(self, *args):
+        """Forget the weights hash (and so every `prediction_cache` entry
+        keyed by it) and the quantized copy of the model. Also an
+        optimizer step hook, hence `*args`."""
+        self._weights_hash = None
+        self._quantized_model = None
+
+    def _prediction_config(self):
+        """Everything other than the weights that affects predictions."""
+        return {
+            "class": type(self).__name__,
+            "enc_tokenizer": tokenizer_fingerprint(self.enc_tokenizer),
+            "dec_tokenizer": tokenizer_fingerprint(self.dec_tokenizer),
+            "max_new_tokens": self.max_new_tokens,
+            "adaptive_max_new_tokens": self.adaptive_max_new_tokens,
+            "generation_length_margin": self.generation_length_margin,
+            "generation_length_ratio": self.generation_length_ratio,
+            "quantize": self.quantize,
+            "decoder": self.decoder,
+            "precision": self.precision,
+            "template_index": (
+                None if self.template_index is None
+                else self.template_index.fingerprint())}
+
+    def fingerprint(self):
+        """Hash of the model weights and `_prediction_config`, used as
+        the key for `prediction_cache`. The weights are hashed once and
+        then again only after an optimizer step, `fit`, or `initialize`."""
+        if self._weights_hash is None:
+            sha = hashlib.sha1()
+            for name, tensor in self.model.state_dict().items():
+                sha.update(name.encode("utf8"))
+                data = tensor.detach().cpu().contiguous().reshape(-1)
+                sha.update(data.view(torch.uint8).numpy())
+            self._weights_hash = sha.hexdigest()
+        config = json.dumps(self._prediction_config(), sort_keys=True)
+        return hashlib.sha1(
+            (config + self._weights_hash).encode("utf8")).hexdigest()
+
+    def fit(self, *args):
+        self._fit_batch_sampler = None
+        if "model" in self.__dict__:
+            # For `warm_start=True`; otherwise this is set by `initialize`:
+            self.model.precision = self.precision
+        gradient_accumulation_steps = self.gradient_accumulation_steps
+        try:
+            with self.stats.stage("fit"):
+                super().fit(*args)
+        finally:
+            self.gradient_accumulation_steps = gradient_accumulation_steps
+            # Early stopping may have restored earlier weights:
+            self._invalidate_weights()
+        if self._fit_batch_sampler is not None:
+            self.padding_efficiency["fit"] = float(np.mean(
+                self._fit_batch_sampler.epoch_padding_efficiency))
+        return self
+
+    def save(self, dirname, half=False, use_safetensors=False):
+        """Save a compact checkpoint to `dirname`: the weights, the
+        `transformers` config of `model.encdec`, and a JSON file with
+        the hyperparameters and the vocab files (and their hashes) for
+        the tokenizers. Optimizer state is not saved.
+
+        Parameters
+        ----------
+        dirname: str
+            Created if necessary.
+        half: bool
+            Store floating-point weights as `float16`. They are cast
+            back to the model's dtype by `load`.
+        use_safetensors: bool
+            Write `model.safetensors` rather than `model.pt`.
+        """
+        os.makedirs(dirname, exist_ok=True)
+        state_dict = {}
+        tied = {}
+        storages = {}
+        tensors = self.model.state_dict()
+        # Buffers left out of `state_dict` (like BERT's `position_ids`)
+        # are saved too, so that `load` needs nothing but the config:
+        buffers = [
+            name for name, _ in self.model.named_buffers()
+            if name not in tensors]
+        tensors.update(
+            (name, buffer) for name, buffer in self.model.named_buffers()
+            if name in buffers)
+        for name, tensor in tensors.items():
+            tensor = tensor.detach().cpu()
+            # Tied weights (e.g., shared embeddings) are stored once:
+            key = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(),
+                   tuple(tensor.shape), tensor.dtype)
+            if key in storages:
+                tied[name] = storages[key]
+                continue
+            storages[key] = name
+            if half and tensor.is_floating_point():
+                tensor = tensor.half()
+            state_dict[name] = tensor.contiguous()
+        if use_safetensors:
+            from safetensors.torch import save_file
+            weights_filename = "model.safetensors"
+            save_file(state_dict, os.path.join(dirname, weights_filename))
+        else:
+            weights_filename = "model.pt"
+            torch.save(state_dict, os.path.join(dirname, weights_filename))
+        encdec = self.model.encdec
+        encdec.config.save_pretrained(dirname)
+        if getattr(encdec, "generation_config", None) is not None:
+            encdec.generation_config.save_pretrained(dirname)
+        params = self.get_params()
+        optimizer_class = params.get("optimizer_class")
+        if optimizer_class is not None:
+            params["optimizer_class"] = (
+                f"{optimizer_class.__module__}.{optimizer_class.__qualname__}")
+        config = {
+            "class": type(self).__name__,
+            "params": params,
+            "weights": weights_filename,
+            "tied": tied,
+            "buffers": buffers,
+            "dtype": str(next(self.model.parameters()).dtype),
+            "enc_vocab_filename": self.enc_vocab_filename,
+            "dec_vocab_filename": self.dec_vocab_filename,
+            "enc_tokenizer": tokenizer_fingerprint(self.enc_tokenizer),
+            "dec_tokenizer": tokenizer_fingerprint(self.dec_tokenizer),
+            "token_cache_dirname": self.token_cache_dirname,
+            "generation_length_ratio": self.generation_length_ratio}
+        with open(os.path.join(dirname, "recogs_model.json"), "w") as f:
+            json.dump(config, f, indent=2)
+
+    @classmethod
+    def load(cls, dirname, **kwargs):
+        """Create a model from a checkpoint written by `save`. The
+        weights are read only when `model` is first used, for example
+        by `predict`. The graph is then built from the saved config,
+        without fetching the pretrained model, and its parameters are
+        the loaded tensors themselves (memory-mapped for `model.pt`
+        checkpoints saved without `half`).
+
+        Parameters
+        ----------
+        dirname: str
+        **kwargs
+            Override the saved hyperparameters, or set others, like
+            `prediction_cache`.
+
+        Returns
+        -------
+        An instance of `cls`
+        """
+        with open(os.path.join(dirname, "recogs_model.json")) as f:
+            config = json.load(f)
+        params = config["params"]
+        optimizer_class = params.get("optimizer_class")
+        if isinstance(optimizer_class, str):
+            module_name, _, class_name = optimizer_class.rpartition(".")
+            params["optimizer_class"] = getattr(
+                importlib.import_module(module_name), class_name)
+        params.update(kwargs)
+        params.setdefault("enc_vocab_filename", config["enc_vocab_filename"])
+        params.setdefault("dec_vocab_filename", config["dec_vocab_filename"])
+        params.setdefault("token_cache_dirname", config["token_cache_dirname"])
+        model = cls(initialize=False, **params)
+        for name in ("enc_tokenizer", "dec_tokenizer"):
+            if tokenizer_fingerprint(getattr(model, name)) != config[name]:
+                raise ValueError(
+                    f"The {name} for this model does not match the one "
+                    f"saved in {dirname}; has its vocab file changed?")
+        model.generation_length_ratio = config["generation_length_ratio"]
+        model._checkpoint = (dirname, config)
+        return model
+
+    def _load_checkpoint_weights(self):
+        dirname, config = self._checkpoint
+        self._checkpoint = None
+        weights_filename = os.path.join(dirname, config["weights"])
+        if weights_filename.endswith(".safetensors"):
+            from safetensors.torch import load_file
+            state_dict = load_file(weights_filename)
+        else:
+            state_dict = torch.load(
+                weights_filename, map_location="cpu",
+                mmap=True, weights_only=True)
+        if "buffers" not in config:
+            # Checkpoints from before configs were saved:
+            for name, source in config["tied"].items():
+                state_dict[name] = state_dict[source]
+            self.initialize()
+            self.model.load_state_dict(state_dict)
+            return
+        from transformers import AutoConfig, GenerationConfig
+        dtype = getattr(torch, config["dtype"].split(".")[-1])
+        if any(tensor.is_floating_point() and tensor.dtype != dtype
+               for tensor in state_dict.values()):
+            # `half` weights are cast back once, here. The other tensors
+            # are copied too, so that nothing keeps the file mapped:
+            state_dict = {
+                name: tensor.to(dtype) if tensor.is_floating_point()
+                else tensor.clone()
+                for name, tensor in state_dict.items()}
+        for name, source in config["tied"].items():
+            state_dict[name] = state_dict[source]
+        buffers = {name: state_dict.pop(name) for name in config["buffers"]}
+        self._encdec_config = AutoConfig.from_pretrained(dirname)
+        try:
+            # No memory is allocated for the parameters on "meta"; they
+            # are replaced by the loaded tensors below:
+            with torch.device("meta"):
+                model = self.build_graph()
+        finally:
+            self._encdec_config = None
+        model.load_state_dict(state_dict, assign=True)
+        for name, buffer in buffers.items():
+            module_name, _, buffer_name = name.rpartition(".")
+            model.get_submodule(module_name).register_buffer(
+                buffer_name, buffer, persistent=False)
+        encdec = model.encdec
+        # `assign=True` gives tied parameters separate `Parameter`
+        # objects on the same storage; tie them again:
+        encdec.tie_weights()
+        if os.path.exists(os.path.join(dirname, "generation_config.json")):
+            encdec.generation_config = GenerationConfig.from_pretrained(dirname)
+        on_meta = [
+            name for name, tensor in itertools.chain(
+                model.named_parameters(), model.named_buffers())
+            if tensor.is_meta]
+        if on_meta:
+            raise ValueError(
+                f"The checkpoint in {dirname} has no values for {on_meta}.")
+        # As in `initialize`:
+        self.model = model.to(self.device)
+        self.optimizer = self.build_optimizer()
+        self.errors = []
+        self._setup_graph()
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, so this is how `load`
+        # defers reading the weights until `model` is needed:
+        if name == "model" and self.__dict__.get("_checkpoint") is not None:
+            self._load_checkpoint_weights()
+            return self.__dict__["model"]
+        raise AttributeError(
+            f"{type(self).__name__!r} object has no attribute {name!r}")
 
     def predict(self, X, device=None):
+        X = list(X)
+        preds = [None] * len(X)
+        for indices, results in self.predict_iter(X, device=device):
+            for i, result in zip(indices, results):
+                preds[i] = result
+        return preds
+
+    def predict_iter(self, X, device=None, sink=None):
+        """Generator version of `predict`, yielding `(indices,
+        predictions)` pairs for each batch as it finishes, where
+        `indices` are positions in `X`. Batches may come in any order.
+
+        Parameters
+        ----------
+        X: iterable of str
+        device: str or None
+        sink: `PredictionSink` or None
+            If given, every batch is appended to it. Examples already
+            recorded in it are yielded first, as a single batch, and
+            are not predicted again.
+
+        Yields
+        ------
+        tuple of list of int and list of str
+        """
+        X = list(X)
+        remaining = list(range(len(X)))
+        if sink is not None:
+            done = sink.read(X)
+            if done:
+                yield list(done.keys()), list(done.values())
+                remaining = [i for i in remaining if i not in done]
+        self.generation_stats = {"sequences": 0, "cap_hits": 0, "decode_steps": 0}
+        # Repeated inputs are predicted only once:
+        positions = {}
+        for i in remaining:
+            positions.setdefault(X[i], []).append(i)
+        unique_X = list(positions)
+        if self.prediction_cache is not None and unique_X:
+            fingerprint = self.fingerprint()
+            cached = self.prediction_cache.get_many(fingerprint, unique_X)
+            if cached:
+                yield self._expand_batch(
+                    list(cached.keys()), list(cached.values()), positions, sink)
+                unique_X = [ex for ex in unique_X if ex not in cached]
+        if self.template_index is not None and unique_X:
+            with self.stats.stage("template"):
+                hits = self.template_index.predict_many(unique_X)
+            if hits:
+                batch_X = list(hits.keys())
+                results = list(hits.values())
+                if self.prediction_cache is not None:
+                    self.prediction_cache.put_many(fingerprint, batch_X, results)
+                yield self._expand_batch(batch_X, results, positions, sink)
+                unique_X = [ex for ex in unique_X if ex not in hits]
+        if not unique_X:
+            return
         device = self.device if device is None else torch.device(device)
-        dataset = self.build_dataset(X)
+        dataset = self.build_dataset(unique_X)
         dataloader = self._build_dataloader(dataset, shuffle=False)
-        self.model.to(device)
-        self.model.eval()
-        preds = []
+        # With `shuffle=False`, the batch sampler is deterministic, so
+        # these are the batches the dataloader will produce:
+        batch_indices = list(dataloader.batch_sampler)
+        self.padding_efficiency["predict"] = padding_efficiency(
+            batch_indices, *dataset.lengths)
+        model = self._get_inference_model(device)
         with torch.no_grad():
-            for batch in dataloader:
-                X_pad, X_mask = [x.to(device) for x in batch]
-                outputs = self.model.encdec.generate(
-                    X_pad,
-                    attention_mask=X_mask,
-                    max_new_tokens=512,
-                    eos_token_id=self.model.encdec.config.eos_token_id)
-                results = self.dec_tokenizer.batch_decode(
-                    outputs, 
-                    skip_special_tokens=True,
-                    clean_up_tokenization_spaces=False)
-                preds += results
-        return preds
+            for indices, batch in zip(batch_indices, dataloader):
+                with self.stats.stage("to_device"):
+                    X_pad, X_mask = [x.to(device) for x in batch]
+                max_new_tokens = self._get_max_new_tokens(X_mask)
+                with self.stats.stage("decode"):
+                    outputs = self._decode(model, X_pad, X_mask, max_new_tokens)
+                self._update_generation_stats(outputs, max_new_tokens)
+                with self.stats.stage("batch_decode"):
+                    results = self.dec_tokenizer.batch_decode(
+                        outputs, 
+                        skip_special_tokens=True,
+                        clean_up_tokenization_spaces=False)
+                batch_X = [unique_X[i] for i in indices]
+                if self.prediction_cache is not None:
+                    self.prediction_cache.put_many(fingerprint, batch_X, results)
+                yield self._expand_batch(batch_X, results, positions, sink)
+
+    def profile(self, X, n_batches=10, trace_filename="recogs_trace.json",
+            device=None):
+        """Run `predict` on `X` for `n_batches` batches under
+        `torch.profiler`, with the `StageStats` stages marked, and
+        export a Chrome trace (viewable in Perfetto or chrome://tracing).
+        The prediction cache is bypassed.
+
+        Returns
+        -------
+        `torch.profiler.profile`
+        """
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        enabled = self.stats.enabled
+        prediction_cache = self.prediction_cache
+        self.stats.enabled = True
+        self.stats.profiling = True
+        self.prediction_cache = None
+        try:
+            with torch.profiler.profile(
+                    activities=activities, record_shapes=True) as prof:
+                batches = self.predict_iter(X, device=device)
+                for _ in zip(range(n_batches), batches):
+                    pass
+                batches.close()
+        finally:
+            self.stats.enabled = enabled
+            self.stats.profiling = False
+            self.prediction_cache = prediction_cache
+        prof.export_chrome_trace(trace_filename)
+        return prof
+
+    def _decode(self, model, X_pad, X_mask, max_new_tokens, step_times=None):
+        with get_autocast(X_pad.device.type, self.precision):
+            return self._decode_batch(
+                model, X_pad, X_mask, max_new_tokens, step_times=step_times)
+
+    def _decode_batch(self, model, X_pad, X_mask, max_new_tokens, step_times=None):
+        # Generation stops as soon as every sequence in the batch has
+        # emitted [EOS]:
+        if self.decoder == "greedy":
+            return greedy_decode(
+                model.encdec,
+                X_pad,
+                X_mask,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=model.encdec.config.eos_token_id,
+                pad_token_id=model.encdec.config.pad_token_id,
+                step_times=step_times)
+        return model.encdec.generate(
+            X_pad,
+            attention_mask=X_mask,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=model.encdec.config.eos_token_id,
+            pad_token_id=model.encdec.config.pad_token_id)
+
+    def _get_inference_model(self, device):
+        """`model` in eval mode on `device`, or its quantized copy if
+        `quantize="int8"`."""
+        device = torch.device(device)
+        if self.quantize is None:
+            self.model.precision = self.precision
+            self.model.to(device)
+            self.model.eval()
+            return self.model
+        if device.type != "cpu":
+            raise ValueError(
+                "`quantize='int8'` uses dynamic quantization, which is "
+                "only supported on CPU.")
+        if self.precision != "fp32":
+            raise ValueError(
+                "`quantize='int8'` cannot be combined with "
+                f"`precision={self.precision!r}`.")
+        if self._quantized_model is None:
+            model = copy.deepcopy(self.model).to(device).eval()
+            self._quantized_model = torch.ao.quantization.quantize_dynamic(
+                model, {nn.Linear}, dtype=torch.qint8)
+        return self._quantized_model
+
+    @staticmethod
+    def _expand_batch(batch_X, results, positions, sink):
+        """Map predictions for distinct inputs back to every position
+        where those inputs occur, recording them in `sink`."""
+        indices = []
+        expanded_X = []
+        preds = []
+        for ex, result in zip(batch_X, results):
+            for i in positions[ex]:
+                indices.append(i)
+                expanded_X.append(ex)
+                preds.append(result)
+        if sink is not None:
+            sink.write(indices, expanded_X, preds)
+        return indices, preds
 
     def score(self, X, y, device=None):
         preds = self.predict(X, device=device)
-        return recogs_exact_match(y, preds)
+        return np.mean(batch_exact_match(y, preds))
+
+def test_prediction_cache_during_fit(X, y, max_iter=3, **model_kwargs):
+    """Fit a `RecogsModel` with a `PredictionCache` and early stopping,
+    checking that each of the per-epoch dev scores uses predictions from
+    the current weights rather than ones cached in an earlier epoch.
+    With `quantize="int8"`, the comparison is with a fresh quantized
+    copy of the current weights."""
+    model = RecogsModel(
+        prediction_cache=PredictionCache(),
+        early_stopping=True,
+        max_iter=max_iter,
+        n_iter_no_change=max_iter,
+        **model_kwargs)
+    fingerprints = []
+    stale = []
+    score = model.score
+
+    def checked_score(X_dev, y_dev, device=None):
+        acc = score(X_dev, y_dev, device=device)
+        fingerprints.append(model.fingerprint())
+        cached = model.predict(X_dev, device=device)
+        prediction_cache = model.prediction_cache
+        model.prediction_cache = None
+        quantized_model = model._quantized_model
+        model._quantized_model = None
+        try:
+            fresh = model.predict(X_dev, device=device)
+        finally:
+            model.prediction_cache = prediction_cache
+            model._quantized_model = quantized_model
+        stale.append(cached != fresh)
+        return acc
+
+    model.score = checked_score
+    model.fit(X, y)
+    errcount = 0
+    if len(set(fingerprints)) != len(fingerprints):
+        errcount += 1
+        print("Error: the fingerprint did not change between epochs.")
+    if any(stale):
+        errcount += 1
+        print(f"Error: stale cached dev predictions in epochs "
+              f"{[i + 1 for i, val in enumerate(stale) if val]}.")
+    if errcount == 0:
+        print(f"No errors found for the prediction cache over "
+              f"{len(fingerprints)} epochs")
+    return errcount
+
+# test_prediction_cache_during_fit(
+#     dataset['train'].input[: 200], dataset['train'].output[: 200], batch_size=20)
+
+def get_dir_size(dirname):
+    return sum(
+        os.path.getsize(os.path.join(dirname, filename))
+        for filename in os.listdir(dirname))
+
+def benchmark_checkpoint(model, dirname="checkpoint_benchmark"):
+    """Compare pickling `model` with `torch.save` against `model.save`
+    in each of its formats: save time, size on disk, time for `load`,
+    time until the weights are usable, and the increase in RSS over
+    that period. The RSS numbers are measured in-process, so they are
+    only indicative; memory-mapped weights count towards RSS only once
+    their pages have been read.
 
-recogs_model = RecogsModel()
+    Returns
+    -------
+    pd.DataFrame
+    """
+    os.makedirs(dirname, exist_ok=True)
+    rows = []
+    pickle_filename = os.path.join(dirname, "model.pickle")
+    start = time.perf_counter()
+    torch.save(model, pickle_filename)
+    save_seconds = time.perf_counter() - start
+    gc.collect()
+    rss_before = get_rss()
+    start = time.perf_counter()
+    loaded = torch.load(pickle_filename, weights_only=False)
+    load_seconds = time.perf_counter() - start
+    rows.append({
+        "format": "torch.save(model)",
+        "save_seconds": save_seconds,
+        "megabytes": os.path.getsize(pickle_filename) / 1e6,
+        "load_seconds": load_seconds,
+        "weights_loaded_seconds": load_seconds,
+        "rss_megabytes": (get_rss() - rss_before) / 1e6})
+    del loaded
+    for half in (False, True):
+        for use_safetensors in (False, True):
+            name = f"{'fp16' if half else 'fp32'}-{'safetensors' if use_safetensors else 'pt'}"
+            checkpoint_dirname = os.path.join(dirname, name)
+            start = time.perf_counter()
+            model.save(checkpoint_dirname, half=half, use_safetensors=use_safetensors)
+            save_seconds = time.perf_counter() - start
+            gc.collect()
+            rss_before = get_rss()
+            start = time.perf_counter()
+            loaded = type(model).load(checkpoint_dirname)
+            load_seconds = time.perf_counter() - start
+            _ = loaded.model
+            weights_loaded_seconds = time.perf_counter() - start
+            rows.append({
+                "format": f"save ({name})",
+                "save_seconds": save_seconds,
+                "megabytes": get_dir_size(checkpoint_dirname) / 1e6,
+                "load_seconds": load_seconds,
+                "weights_loaded_seconds": weights_loaded_seconds,
+                "rss_megabytes": (get_rss() - rss_before) / 1e6})
+            del loaded
+    results_df = pd.DataFrame(rows)
+    print(results_df.to_string())
+    return results_df
+
+# benchmark_checkpoint(recogs_model)
+
+def benchmark_quantization(model, X, y, batch_sizes=(1, 8, 32, 128),
+        device="cpu"):
+    """Exact-match accuracy on `X`, `y` and prediction latency across
+    `batch_sizes`, for `model` in fp32 and with `quantize="int8"`. The
+    model's prediction cache is disabled while this runs.
 
-"""Predictions for our first to train cases"""
+    Returns
+    -------
+    accuracy_df, latency_df: pd.DataFrame
+    """
+    X = list(X)
+    y = list(y)
+    params = {
+        "quantize": model.quantize,
+        "batch_size": model.batch_size,
+        "prediction_cache": model.prediction_cache}
+    model.prediction_cache = None
+    accuracy_rows = []
+    latency_rows = []
+    try:
+        for quantize in (None, "int8"):
+            label = quantize or "fp32"
+            model.quantize = quantize
+            model.batch_size = params["batch_size"]
+            preds = model.predict(X, device=device)
+            accuracy_rows.append({
+                "mode": label,
+                "accuracy": np.mean(batch_exact_match(y, preds))})
+            for batch_size in batch_sizes:
+                model.batch_size = batch_size
+                start = time.perf_counter()
+                model.predict(X, device=device)
+                seconds = time.perf_counter() - start
+                n_batches = math.ceil(len(set(X)) / batch_size)
+                latency_rows.append({
+                    "mode": label,
+                    "batch_size": batch_size,
+                    "seconds": seconds,
+                    "examples_per_second": len(X) / seconds,
+                    "ms_per_batch": 1000 * seconds / n_batches})
+    finally:
+        model.quantize = params["quantize"]
+        model.batch_size = params["batch_size"]
+        model.prediction_cache = params["prediction_cache"]
+    accuracy_df = pd.DataFrame(accuracy_rows)
+    latency_df = pd.DataFrame(latency_rows)
+    print(accuracy_df.to_string(index=False))
+    print(latency_df.to_string(index=False))
+    return accuracy_df, latency_df
+
+# benchmark_quantization(recogs_model, dataset['dev'].input, dataset['dev'].output)
+
+def _iter_decoding_batches(model, X, device):
+    dataset = model.build_dataset(list(X))
+    dataloader = model._build_dataloader(dataset, shuffle=False)
+    for batch in dataloader:
+        X_pad, X_mask = [x.to(device) for x in batch]
+        yield X_pad, X_mask, model._get_max_new_tokens(X_mask)
+
+def test_greedy_decode(model, X, device="cpu"):
+    """Check that `greedy_decode` matches `generate` token for token on
+    every batch that `model` would form from `X`. This does not hold
+    exactly with `quantize="int8"`, since dynamic quantization scales
+    activations by batch, and `greedy_decode` shrinks the batch."""
+    device = torch.device(device)
+    inference_model = model._get_inference_model(device)
+    encdec = inference_model.encdec
+    errcount = 0
+    with torch.no_grad():
+        for X_pad, X_mask, max_new_tokens in _iter_decoding_batches(model, X, device):
+            expected = encdec.generate(
+                X_pad,
+                attention_mask=X_mask,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=encdec.config.eos_token_id,
+                pad_token_id=encdec.config.pad_token_id)
+            result = greedy_decode(
+                encdec, X_pad, X_mask, max_new_tokens,
+                eos_token_id=encdec.config.eos_token_id,
+                pad_token_id=encdec.config.pad_token_id)
+            if expected.shape != result.shape or not torch.equal(expected, result):
+                errcount += 1
+    if errcount == 0:
+        print("No errors for `greedy_decode`")
+    else:
+        print(f"Error `greedy_decode`: {errcount} batches differ from `generate`")
 
-recogs_model.predict(dataset['dev'].input[: 2])
+def benchmark_greedy_decode(model, X, device="cpu"):
+    """Time `generate` and `greedy_decode` on the batches that `model`
+    would form from `X`, and report the latency of each `greedy_decode`
+    step by the number of sequences still active in it.
 
-dataset['dev']
+    Returns
+    -------
+    pd.DataFrame
+        One row per active batch size, with the number of steps, mean
+        milliseconds per step, and mean milliseconds per generated token
+    """
+    device = torch.device(device)
+    inference_model = model._get_inference_model(device)
+    encdec = inference_model.encdec
+    batches = list(_iter_decoding_batches(model, X, device))
+    timings = {}
+    step_times = []
+    with torch.no_grad():
+        for name in ("generate", "greedy"):
+            start = time.perf_counter()
+            for X_pad, X_mask, max_new_tokens in batches:
+                if name == "generate":
+                    encdec.generate(
+                        X_pad,
+                        attention_mask=X_mask,
+                        max_new_tokens=max_new_tokens,
+                        eos_token_id=encdec.config.eos_token_id,
+                        pad_token_id=encdec.config.pad_token_id)
+                else:
+                    greedy_decode(
+                        encdec, X_pad, X_mask, max_new_tokens,
+                        eos_token_id=encdec.config.eos_token_id,
+                        pad_token_id=encdec.config.pad_token_id,
+                        step_times=step_times)
+            timings[name] = time.perf_counter() - start
+    for name, seconds in timings.items():
+        print(f"{name}: {seconds:.2f}s")
+    steps_df = pd.DataFrame(step_times, columns=["active", "seconds"])
+    summary_df = steps_df.groupby("active").seconds.agg(["size", "mean"])
+    summary_df.columns = ["steps", "ms_per_step"]
+    summary_df["ms_per_step"] *= 1000
+    summary_df["ms_per_token"] = summary_df.ms_per_step / summary_df.index
+    summary_df = summary_df.sort_index(ascending=False)
+    print(summary_df.to_string())
+    return summary_df
+
+def benchmark_template_index(model, template_index, split_df):
+    """Hit rate of `template_index` on `split_df` (e.g., `dataset['dev']`),
+    exact-match accuracy of its answers next to the model's on the same
+    examples, and `predict` time with and without the index. The
+    model's prediction cache is disabled while this runs.
+
+    Returns
+    -------
+    dict
+    """
+    X = list(split_df.input)
+    y = list(split_df.output)
+    params = {
+        "template_index": model.template_index,
+        "prediction_cache": model.prediction_cache}
+    model.prediction_cache = None
+    try:
+        model.template_index = None
+        start = time.perf_counter()
+        model_preds = model.predict(X)
+        model_seconds = time.perf_counter() - start
+        model.template_index = template_index
+        start = time.perf_counter()
+        preds = model.predict(X)
+        template_seconds = time.perf_counter() - start
+    finally:
+        model.template_index = params["template_index"]
+        model.prediction_cache = params["prediction_cache"]
+    hits = template_index.predict_many(X)
+    hit_rows = [i for i, ex in enumerate(X) if ex in hits]
+    hit_y = [y[i] for i in hit_rows]
+    results = {
+        "templates": len(template_index),
+        "hit_rate": len(hit_rows) / len(X),
+        "template_accuracy_on_hits": np.mean(batch_exact_match(
+            hit_y, [hits[X[i]] for i in hit_rows])),
+        "model_accuracy_on_hits": np.mean(batch_exact_match(
+            hit_y, [model_preds[i] for i in hit_rows])),
+        "model_accuracy": np.mean(batch_exact_match(y, model_preds)),
+        "accuracy_with_templates": np.mean(batch_exact_match(y, preds)),
+        "model_seconds": model_seconds,
+        "seconds_with_templates": template_seconds}
+    for key, val in results.items():
+        print(f"{key}: {val:.3f}" if isinstance(val, float) else f"{key}: {val}")
+    return results
+
+# benchmark_template_index(
+#     recogs_model, TemplateIndex.from_split(dataset['train']), dataset['dev'])
+
+# test_greedy_decode(recogs_model, dataset['dev'].input[: 200])
+# benchmark_greedy_decode(recogs_model, dataset['dev'].input[: 200])
+
+def run_precision_config(model_class, model_kwargs, X_train, y_train,
+        X_dev, y_dev):
+    """Fit and assess one model, returning timings, the peak RSS of
+    this process, and dev accuracy. Run it in a fresh process (as
+    `benchmark_precision` does) for the peak RSS to be meaningful."""
+    torch.manual_seed(0)
+    model = model_class(**model_kwargs)
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    n_epochs = len(getattr(model, "errors", [])) or model.max_iter
+    start = time.perf_counter()
+    preds = model.predict(X_dev)
+    predict_seconds = time.perf_counter() - start
+    return {
+        "precision": model.precision,
+        "fit_seconds": fit_seconds,
+        "train_examples_per_second": n_epochs * len(X_train) / fit_seconds,
+        "predict_seconds": predict_seconds,
+        "dev_examples_per_second": len(X_dev) / predict_seconds,
+        "peak_rss_mb": get_peak_rss() / 1e6,
+        "accuracy": np.mean(batch_exact_match(y_dev, preds))}
+
+def benchmark_precision(X_train, y_train, X_dev, y_dev, model_class=None,
+        **model_kwargs):
+    """Fit and assess a model with `precision="fp32"` and another with
+    `precision="bf16"`, using the same `model_kwargs` (e.g., `eta` and
+    `max_iter`), each in its own process.
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    model_class = RecogsModel if model_class is None else model_class
+    args = [list(X_train), list(y_train), list(X_dev), list(y_dev)]
+    rows = []
+    for precision in ("fp32", "bf16"):
+        kwargs = {**model_kwargs, "precision": precision}
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=context) as pool:
+            rows.append(pool.submit(
+                run_precision_config, model_class, kwargs, *args).result())
+    results_df = pd.DataFrame(rows)
+    print(results_df.to_string(index=False))
+    return results_df
+
+# benchmark_precision(
+#     dataset['train'].input, dataset['train'].output,
+#     dataset['dev'].input, dataset['dev'].output,
+#     model_class=T5BaseRecogsModel, eta=0.00005, max_iter=5)
+
+@functools.lru_cache(maxsize=None)
+def get_recogs_model():
+    return RecogsModel()
+
+if __name__ == "__main__":
+    recogs_model = get_recogs_model()
+
+    """Predictions for our first to train cases"""
+
+    recogs_model.predict(dataset['dev'].input[: 2])
+
+    dataset['dev']
 
 """## Question 2: Exploring predictions [2 points]
 
@@ -562,30 +3259,146 @@ Now that we are set up to use the model, we can move to Question 2. There is jus
 The function `recogs_exact_match` does this. It's a complex function, and so you can ignore its precise implementation details. Here are some illustrative examples to give you a feel for it:
 """
 
-# The precise names of bound variables do not matter:
+if __name__ == "__main__":
+    # The precise names of bound variables do not matter:
+
+    recogs_exact_match(
+        "dog ( 4 ) AND happy ( 4 )", 
+        "dog ( 7 ) AND happy ( 7 ) ")
 
-recogs_exact_match(
-    "dog ( 4 ) AND happy ( 4 )", 
-    "dog ( 7 ) AND happy ( 7 ) ")
+    # The order of conjuncts does not matter:
 
-# The order of conjuncts does not matter:
+    recogs_exact_match(
+        "dog ( 4 ) AND happy ( 4 )", 
+        "happy ( 7 ) AND dog ( 7 )")
 
-recogs_exact_match(
-    "dog ( 4 ) AND happy ( 4 )", 
-    "happy ( 7 ) AND dog ( 7 )")
+    # Consistency of variable names does matter:
 
-# Consistency of variable names does matter:
+    recogs_exact_match(
+        "dog ( 4 ) AND happy ( 4 )", 
+        "dog ( 4 ) AND happy ( 7 )")
 
-recogs_exact_match(
-    "dog ( 4 ) AND happy ( 4 )", 
-    "dog ( 4 ) AND happy ( 7 )")
+"""`recogs_exact_match` handles variable renaming and conjunct order with a general search, which makes it slow to call once per row. `canonical_lf` instead puts an LF into a normal form: conjuncts are sorted within each `;`-separated segment (comparing them with variables masked), and variables are then renumbered in order of first occurrence. LFs with the same canonical form are equivalent, so `batch_exact_match` only falls back to `recogs_exact_match` for pairs whose canonical forms differ:"""
+
+import random
+
+def canonical_lf(lf):
+    """Normal form of `lf` that is invariant to variable names and, up
+    to ties among conjuncts that differ only in their variables, to
+    conjunct order.
+
+    Parameters
+    ----------
+    lf: str
+
+    Returns
+    -------
+    str
+    """
+    segments = []
+    for segment in " ".join(lf.split()).split(" ; "):
+        conjuncts = [conj.split() for conj in segment.split(" AND ")]
+        conjuncts.sort(key=lambda toks: [
+            "#" if tok.isdigit() else tok for tok in toks])
+        segments.append(conjuncts)
+    renaming = {}
+    canonical = []
+    for conjuncts in segments:
+        canonical.append(" AND ".join(
+            " ".join(
+                renaming.setdefault(tok, str(len(renaming)))
+                if tok.isdigit() else tok
+                for tok in toks)
+            for toks in conjuncts))
+    return " ; ".join(canonical)
+
+def fast_exact_match(gold, pred):
+    """Same result as `recogs_exact_match(gold, pred)`, but checks the
+    canonical forms first."""
+    if canonical_lf(gold) == canonical_lf(pred):
+        return True
+    return recogs_exact_match(gold, pred)
+
+def _exact_match_rows(pairs):
+    return [fast_exact_match(gold, pred) for gold, pred in pairs]
+
+def batch_exact_match(golds, preds, n_jobs=1, pool=None):
+    """`recogs_exact_match` for every pair in `zip(golds, preds)`,
+    optionally sharded across a process pool.
+
+    Parameters
+    ----------
+    golds: iterable of str
+    preds: iterable of str
+    n_jobs: int
+        -1 means use all CPUs.
+    pool: `concurrent.futures.Executor` or None
+
+    Returns
+    -------
+    list of bool
+    """
+    pairs = list(zip(golds, preds))
+    parts = map_shards(_exact_match_rows, pairs, n_jobs, pool=pool)
+    return [result for part in parts for result in part]
+
+def test_batch_exact_match(golds, preds, n_jobs=1):
+    """Check that `batch_exact_match` agrees with `recogs_exact_match`
+    on every pair, and that gold LFs with renamed variables and
+    shuffled conjuncts are recognized as matches."""
+    golds = list(golds)
+    preds = list(preds)
+    rng = random.Random(0)
+    def scramble(lf):
+        variables = sorted(set(re.findall(r"\b\d+\b", lf)))
+        renaming = dict(zip(
+            variables, map(str, rng.sample(range(1000), len(variables)))))
+        segments = []
+        for segment in lf.split(" ; "):
+            conjuncts = segment.split(" AND ")
+            rng.shuffle(conjuncts)
+            segments.append(" AND ".join(conjuncts))
+        return re.sub(
+            r"\b\d+\b", lambda m: renaming[m.group(0)], " ; ".join(segments))
+    scrambled = [scramble(lf) for lf in golds]
+    errcount = 0
+    for name, others in (("predictions", preds), ("scrambled golds", scrambled)):
+        expected = [recogs_exact_match(g, p) for g, p in zip(golds, others)]
+        result = batch_exact_match(golds, others, n_jobs=n_jobs)
+        mismatches = sum(e != r for e, r in zip(expected, result))
+        if mismatches:
+            errcount += 1
+            print(f"Error `batch_exact_match`: {mismatches} disagreements "
+                  f"with `recogs_exact_match` on {name}")
+    if errcount == 0:
+        print("No errors for `batch_exact_match`")
+
+def benchmark_batch_exact_match(golds, preds, n_jobs_values=(1, 2, 4)):
+    """Pairs per second for a `recogs_exact_match` loop and for
+    `batch_exact_match` at each of `n_jobs_values`."""
+    golds = list(golds)
+    preds = list(preds)
+    start = time.perf_counter()
+    _ = [recogs_exact_match(g, p) for g, p in zip(golds, preds)]
+    elapsed = time.perf_counter() - start
+    print(f"recogs_exact_match loop: {len(golds) / elapsed:,.0f} pairs/s")
+    for n_jobs in n_jobs_values:
+        start = time.perf_counter()
+        _ = batch_exact_match(golds, preds, n_jobs=n_jobs)
+        elapsed = time.perf_counter() - start
+        print(f"batch_exact_match, n_jobs={n_jobs}: "
+              f"{len(golds) / elapsed:,.0f} pairs/s")
+
+# test_batch_exact_match(dataset['dev'].output, dataset['dev'].output)
+# test_batch_exact_match(dataset['gen'].output, dataset['gen'].output)
+# benchmark_batch_exact_match(dataset['gen'].output, dataset['gen'].output)
 
 """### Task
 
 Your task is to write a utility function to see how well a model does on a specific generalization category in the generalization dataset. The metric is accuracy according to `recogs_exact_match`.
 """
 
-def category_assess(gen_df, model, category):
+def category_assess(gen_df, model, category, sink=None):
     """Assess `model` against the `category` examples in `gen_df`.
 
     Parameters
@@ -595,6 +3408,10 @@ def category_assess(gen_df, model, category):
     model: A `RecogsModel instance
     category: str
         A string from `gen_df.category`
+    sink: `PredictionSink` or None
+        Streams predictions to disk as they are made, so that an
+        interrupted run can be resumed (see `RecogsModel.predict_iter`).
+        Use a separate sink for each category.
 
     Returns
     -------
@@ -608,16 +3425,15 @@ def category_assess(gen_df, model, category):
     # Step 1: Add a column called "prediction" to `cat_df`. This should
     # give the predicted LFs:
     ##### YOUR CODE HERE
-    cat_df["prediction"] = model.predict(cat_df.input)
+    cat_df["prediction"] = collect_predictions(model, cat_df.input, sink=sink)
 
 
     # Step 2: Add a column "correct" that says whether the prediction
-    # and the gold output are the same. Must use `recogs_exact_match`.
+    # and the gold output are the same. Must use `recogs_exact_match`
+    # (which `batch_exact_match` falls back to).
     ##### YOUR CODE HERE
-    cat_df["correct"] = cat_df.apply(
-        lambda row: recogs_exact_match(row.output, row.prediction),
-        axis=1
-    )
+    with model.stats.stage("score"):
+        cat_df["correct"] = batch_exact_match(cat_df.output, cat_df.prediction)
 
 
     # Step 3: Return the `pd.DataFrame` `cat_df`:
@@ -626,7 +3442,7 @@ def category_assess(gen_df, model, category):
 
 def test_category_assess(func):
     testmod = RecogsModel()
-    samp_df = dataset['gen'].head(150)
+    samp_df = get_dataset()['gen'].head(150)
     examples = [
         ("active_to_passive", 0.80),
         ("unacc_to_transitive", 0.86),
@@ -664,9 +3480,81 @@ def test_category_assess(func):
 
 # test_category_assess(category_assess)
 
+"""`category_assess` runs a separate generation pass for every category, so a per-category loop gives small categories small, inefficient batches. `evaluate_categories` predicts the whole frame in one batched pass, scores it once, and summarizes it by category:"""
+
+def evaluate_categories(gen_df, model, sink=None):
+    """Assess `model` against every category in `gen_df` at once.
+
+    Parameters
+    ----------
+    gen_df: pd.DataFrame
+        Should be `dataset["gen"]` or a subset of it
+    model: A `RecogsModel` instance
+    sink: `PredictionSink` or None
+        Streams predictions to disk as they are made (see
+        `RecogsModel.predict_iter`).
+
+    Returns
+    -------
+    pred_df: pd.DataFrame
+        Copy of `gen_df` with columns "prediction" and "correct" added,
+        as in `category_assess`
+    summary_df: pd.DataFrame
+        Indexed by category, with columns "examples", "correct", and
+        "accuracy", plus rows "macro" (mean of the category accuracies)
+        and "micro" (accuracy over all examples)
+    """
+    pred_df = gen_df.copy()
+    pred_df["prediction"] = collect_predictions(model, pred_df.input, sink=sink)
+    with model.stats.stage("score"):
+        pred_df["correct"] = batch_exact_match(pred_df.output, pred_df.prediction)
+    summary_df = pred_df.groupby("category", sort=True, observed=True).correct.agg(
+        examples="size", correct="sum")
+    summary_df["accuracy"] = summary_df.correct / summary_df.examples
+    summary_df.loc["macro"] = [
+        summary_df.examples.sum(),
+        summary_df.correct.sum(),
+        summary_df.accuracy.mean()]
+    summary_df.loc["micro"] = [
+        pred_df.shape[0],
+        pred_df.correct.sum(),
+        pred_df.correct.mean()]
+    summary_df = summary_df.astype({"examples": int, "correct": int})
+    return pred_df, summary_df
+
+def benchmark_evaluate_categories(gen_df, model):
+    """Compare a per-category `category_assess` loop with a single
+    `evaluate_categories` call. The model's prediction cache, if any,
+    is disabled so that both make all of their predictions."""
+    prediction_cache = model.prediction_cache
+    model.prediction_cache = None
+    try:
+        start = time.perf_counter()
+        loop_acc = {}
+        for cat in gen_df.category.unique():
+            cat_df = category_assess(gen_df, model, cat)
+            loop_acc[cat] = cat_df.correct.sum() / cat_df.shape[0]
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        _, summary_df = evaluate_categories(gen_df, model)
+        one_pass_time = time.perf_counter() - start
+    finally:
+        model.prediction_cache = prediction_cache
+    same = all(
+        np.isclose(summary_df.accuracy[cat], acc)
+        for cat, acc in loop_acc.items())
+    print(f"category_assess loop: {loop_time:.2f}s")
+    print(f"evaluate_categories:  {one_pass_time:.2f}s "
+          f"({loop_time / one_pass_time:.1f}x)")
+    print(f"Same accuracies: {same}")
+    return summary_df
+
+# benchmark_evaluate_categories(dataset['gen'], recogs_model)
+
 """Question 1 above might lead you to expect that our model will struggle with examples in which proper names appear with totally unfamiliar roles. For that question, you wrote `get_propername_role` to get `(name, role)` pairs from examples and `find_name_roles` to do analyses with that function. We can now run that same analysis on our errors:"""
 
-gen_df = dataset['gen']
+if __name__ == "__main__":
+    gen_df = dataset['gen']
 
 # Depending on your computer, this could take a while. On a relatively
 # new Apple laptop, it took about 3 minutes. Colab will be much more
@@ -728,8 +3616,8 @@ Standard set-up for DSP, but we don't need a retriever:
 # This will convert the train set into a list of `dsp.Example` instances to use for demonstrations:
 # """
 
-# dsp_recogs_train = [dsp.Example(input=row['input'], output=row['output'])
-#                     for _, row in dataset['train'].iterrows()]
+# dsp_recogs_train = [dsp.Example(input=x, output=y)
+#                     for x, y in zip(dataset['train'].input, dataset['train'].output)]
 
 # """### Basic template"""
 
@@ -829,6 +3717,697 @@ Here we sample 10 dev cases for a small evaluation. If you adapt this code, reme
 
 # ssamp.sample(1).to_dict(orient='records')
 
+"""### Faster assessment
+
+The cells above make one blocking LM call per example. The code below evaluates the same kind of program over many dev rows concurrently and repeatably:
+
+* An LM backend is any callable `lm(prompt, **kwargs)` that returns a list of completions. The DSP LMs from the set-up (`dsp.Cohere`, `dsp.GPT3`) work as they are, and `LocalLM` is an offline stand-in for testing.
+* `CompletionCache` stores completions on disk, keyed by the LM, the full prompt (instructions, demos, and input), and the decoding parameters.
+* `LMDispatcher` runs prompts through an LM with `asyncio`, with at most `concurrency` calls in flight and retries with exponential backoff.
+* `RecogsICL` builds prompts in the format of `cogs_template` from `k` train demos per input, chosen deterministically so that reruns hit the cache.
+
+As with everything else, demos come only from in-distribution examples."""
+
+import asyncio
+
+RECOGS_ICL_INSTRUCTIONS = "Translate sentences into logical forms."
+
+def format_recogs_prompt(x, demos, instructions=RECOGS_ICL_INSTRUCTIONS):
+    """Prompt for input `x` with `demos`, a list of `(input, output)`
+    pairs, laid out as `cogs_template` lays out its examples."""
+    sep = "\n\n---\n\n"
+    parts = [
+        instructions,
+        "Follow the following format.\n\n"
+        "Input: ${the sentence to be translated}\n"
+        "Output: ${a logical form}"]
+    parts += [f"Input: {demo_x}\nOutput: {demo_y}" for demo_x, demo_y in demos]
+    parts.append(f"Input: {x}\nOutput:")
+    return sep.join(parts)
+
+def get_lm_name(lm):
+    """Name for `lm` in cache keys: its `name`, the `model` of a DSP
+    LM, or its class name."""
+    name = getattr(lm, "name", None)
+    if name is None:
+        name = getattr(lm, "kwargs", {}).get("model")
+    return name or type(lm).__name__
+
+class LocalLM:
+    """Offline stand-in for a hosted LM.
+
+    Parameters
+    ----------
+    predict_fn: callable or None
+        Maps the final `Input:` of a prompt to a completion, e.g.,
+        `lambda x: recogs_model.predict([x])[0]`. If None, the output
+        of the last demo in the prompt is copied.
+    latency: float
+        Seconds each call sleeps, to simulate a network round trip.
+    failure_rate: float
+        Probability that a call raises `ConnectionError`, to exercise
+        retries.
+    seed: int
+    name: str
+    """
+    def __init__(self, predict_fn=None, latency=0.0, failure_rate=0.0,
+            seed=0, name="local"):
+        self.predict_fn = predict_fn
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.name = name
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt, n=1, **kwargs):
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise ConnectionError("Simulated LM failure.")
+        blocks = prompt.split("\n\n---\n\n")
+        x = blocks[-1].split("\n")[0][len("Input: "): ]
+        if self.predict_fn is not None:
+            completion = self.predict_fn(x)
+        elif len(blocks) > 3:
+            completion = blocks[-2].split("\nOutput: ", 1)[1]
+        else:
+            completion = ""
+        return [completion] * n
+
+class CompletionCache:
+    """Disk-backed map from LM calls to their completions.
+
+    Parameters
+    ----------
+    filename: str or None
+        SQLite database for persistent storage. If None, the cache
+        lives only in memory.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.memory = {}
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None and self.filename is not None:
+            # The dispatcher may run its event loop in a helper thread:
+            self._connection = sqlite3.connect(
+                self.filename, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, completions TEXT)")
+        return self._connection
+
+    @staticmethod
+    def key(lm_name, prompt, decoding):
+        return hashlib.sha1(json.dumps(
+            {"lm": lm_name, "prompt": prompt, "decoding": decoding},
+            sort_keys=True).encode("utf8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key in self.memory:
+                return self.memory[key]
+            if self.connection is None:
+                return None
+            row = self.connection.execute(
+                "SELECT completions FROM completions WHERE key = ?",
+                (key, )).fetchone()
+            if row is None:
+                return None
+            self.memory[key] = json.loads(row[0])
+            return self.memory[key]
+
+    def put(self, key, completions):
+        with self._lock:
+            self.memory[key] = completions
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO completions VALUES (?, ?)",
+                        (key, json.dumps(completions)))
+
+def run_coroutine(coro):
+    """Run `coro` to completion, also from inside a running event
+    loop (as in Jupyter and Colab), where `asyncio.run` is not
+    allowed."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+# Errors that are worth retrying by default. Others, like a `TypeError`
+# from a bad decoding argument, are raised at once. Add the rate-limit
+# and server errors of a hosted LM's client library as needed:
+TRANSIENT_LM_ERRORS = (ConnectionError, TimeoutError)
+
+class LMDispatcher:
+    """Concurrent, cached, retrying calls to an LM.
+
+    Parameters
+    ----------
+    lm: callable
+        `lm(prompt, **decoding)` returns a list of completions.
+    cache: `CompletionCache` or None
+    concurrency: int
+        Maximum number of calls in flight.
+    retries: int
+        Number of times a failed call is retried.
+    backoff: float
+        Seconds before the first retry, doubling for each later one.
+    retry_on: tuple of exception classes
+        The errors that are retried. All others are raised
+        immediately. Default: `TRANSIENT_LM_ERRORS`.
+    **decoding: keyword arguments for `lm`, e.g., `temperature`.
+    """
+    def __init__(self, lm, cache=None, concurrency=8, retries=3, backoff=1.0,
+            retry_on=TRANSIENT_LM_ERRORS, **decoding):
+        self.lm = lm
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+        self.decoding = decoding
+        self.stats = {"calls": 0, "cache_hits": 0, "retries": 0}
+
+    async def _complete(self, prompt, semaphore, executor):
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(get_lm_name(self.lm), prompt, self.decoding)
+            completions = self.cache.get(key)
+            if completions is not None:
+                self.stats["cache_hits"] += 1
+                return completions
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.stats["calls"] += 1
+                    loop = asyncio.get_running_loop()
+                    completions = await loop.run_in_executor(
+                        executor,
+                        functools.partial(self.lm, prompt, **self.decoding))
+                    break
+                except self.retry_on:
+                    if attempt == self.retries:
+                        raise
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        completions = list(completions)
+        if key is not None:
+            self.cache.put(key, completions)
+        return completions
+
+    async def acomplete_many(self, prompts):
+        """Completions for each of `prompts`, in order. Repeated
+        prompts are sent only once."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        unique = list(dict.fromkeys(prompts))
+        # The default executor has too few threads for blocking LM
+        # calls at high concurrency:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as executor:
+            results = await asyncio.gather(
+                *(self._complete(prompt, semaphore, executor)
+                  for prompt in unique))
+        results = dict(zip(unique, results))
+        return [results[prompt] for prompt in prompts]
+
+    def complete_many(self, prompts):
+        return run_coroutine(self.acomplete_many(list(prompts)))
+
+class RecogsICL:
+    """Few-shot ReCOGS program, like `recogs_dsp`, run through an
+    `LMDispatcher`.
+
+    Parameters
+    ----------
+    dispatcher: `LMDispatcher`
+    train_df: pd.DataFrame
+        Source of demos. Only in-distribution examples are allowed.
+    k: int
+        Number of demos per input.
+    demo_selector: callable, `DemoIndex`, or None
+        `demo_selector(x, k)` returns a list of `(input, output)`
+        pairs. A `DemoIndex` is queried in batches. If None, `k`
+        train examples are sampled with a seed derived from `x`, so
+        that each input always gets the same prompt.
+    seed: int
+    """
+    def __init__(self, dispatcher, train_df, k=2, demo_selector=None, seed=0):
+        categories = set(train_df.category.unique())
+        if categories - {"in_distribution"}:
+            raise ValueError(
+                "Demos can only come from in-distribution examples "
+                f"(like `dataset['train']`), not {sorted(categories)}.")
+        self.dispatcher = dispatcher
+        self.train_inputs = list(train_df.input)
+        self.train_outputs = list(train_df.output)
+        self.k = k
+        self.demo_selector = demo_selector
+        self.seed = seed
+
+    def select_demos(self, x):
+        if self.demo_selector is not None:
+            return self.demo_selector(x, self.k)
+        rng = random.Random(f"{self.seed}:{x}")
+        indices = rng.sample(range(len(self.train_inputs)), self.k)
+        return [(self.train_inputs[i], self.train_outputs[i]) for i in indices]
+
+    def prompt(self, x):
+        return format_recogs_prompt(x, self.select_demos(x))
+
+    def prompts(self, X):
+        X = list(X)
+        if hasattr(self.demo_selector, "select_many"):
+            demos = self.demo_selector.select_many(X, self.k)
+        else:
+            demos = [self.select_demos(x) for x in X]
+        return [format_recogs_prompt(x, d) for x, d in zip(X, demos)]
+
+    def predict(self, X):
+        """First line of the first completion for each member of `X`."""
+        completions = self.dispatcher.complete_many(self.prompts(X))
+        return [
+            compl[0].strip().split("\n")[0].strip() if compl else ""
+            for compl in completions]
+
+def benchmark_lm_dispatch(lm, train_df, X, concurrencies=(1, 8, 32), k=2):
+    """Time `RecogsICL.predict` on `X` at each level of concurrency,
+    each with a fresh in-memory cache, followed by a rerun that
+    should be answered entirely from that cache, and count the rerun
+    predictions that differ from the first run."""
+    for concurrency in concurrencies:
+        dispatcher = LMDispatcher(
+            lm, cache=CompletionCache(), concurrency=concurrency, backoff=0.01)
+        program = RecogsICL(dispatcher, train_df, k=k)
+        start = time.perf_counter()
+        preds = program.predict(X)
+        seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        cached_preds = program.predict(X)
+        cached_seconds = time.perf_counter() - start
+        print(f"concurrency={concurrency}: {seconds:.2f}s, "
+              f"rerun from cache: {cached_seconds:.3f}s, {dispatcher.stats}")
+        mismatches = sum(p != c for p, c in zip(preds, cached_preds))
+        if mismatches:
+            print(f"Error for concurrency={concurrency}: {mismatches} "
+                  "predictions differ in the rerun from cache")
+
+# benchmark_lm_dispatch(
+#     LocalLM(latency=0.05, failure_rate=0.05), dataset['train'],
+#     dataset['dev'].input[: 200])
+
+"""### Retrieving demos
+
+Random demos ignore what the input looks like. `DemoIndex` retrieves the `k` train examples most similar to an input, by cosine similarity of TF-IDF vectors over word n-grams. Given a `lexicon` (e.g., `TemplateIndex.lexicon`), it compares lexical skeletons, so that inputs with the same structure but different nouns and names count as identical. Queries whose document occurs at least `k` times in train are answered from a hash table of documents, without any vector arithmetic. The index is built once from the train split with scikit-learn's `TfidfVectorizer` and keeps only plain arrays: the n-gram vocabulary, the IDF weights, and one sparse row per distinct train document. Queries are vectorized with dict lookups into that vocabulary and scored with a sparse product against the transposed matrix. The arrays are saved with `np.save` and `scipy.sparse.save_npz` next to a JSON config, so a saved index does not depend on the scikit-learn version. For a train split of 24k examples, we measured about 0.01ms per query for hash-table hits. Other queries took 0.2-0.5ms one at a time and 0.07-0.4ms per example in batches; the higher figures are for 24k distinct documents. Pass it as the `demo_selector` of `RecogsICL`, or use it in a DSP program as below."""
+
+class DemoIndex:
+    """Top-`k` retrieval of train examples to use as demos.
+
+    Parameters
+    ----------
+    vocabulary: dict
+        Maps the word n-grams of the train documents to columns of
+        `matrix`.
+    idf: np.array of float32
+        The inverse document frequency of each column.
+    matrix: scipy.sparse.csr_matrix
+        The L2-normalized TF-IDF vectors of the distinct train
+        documents.
+    doc_ids: np.array of int
+        The row of `matrix` for each train example.
+    inputs: np.array of str
+    outputs: np.array of str
+    ngram_range: tuple of int
+    lexicon: dict or None
+        Maps slot words to the placeholders that replace them in the
+        documents, as in `TemplateIndex`.
+    fingerprint: str
+        Hash of the train inputs and outputs.
+    exact: dict or None
+        Maps each train document to the indices of its first
+        occurrences.
+    """
+    max_exact = 32
+
+    config_filename = "demo_index.json"
+
+    def __init__(self, vocabulary, idf, matrix, doc_ids, inputs, outputs,
+            ngram_range=(1, 3), lexicon=None, fingerprint=None, exact=None):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.matrix = matrix
+        self.doc_ids = doc_ids
+        self.inputs = inputs
+        self.outputs = outputs
+        self.ngram_range = tuple(ngram_range)
+        self.lexicon = lexicon
+        self.fingerprint = fingerprint
+        self.exact = {} if exact is None else exact
+        self._matrix_t = None
+        # The train examples grouped by document, in order:
+        self._doc_examples = np.argsort(self.doc_ids, kind="stable")
+        self._doc_counts = np.bincount(self.doc_ids, minlength=matrix.shape[0])
+        self._doc_starts = np.cumsum(self._doc_counts) - self._doc_counts
+
+    @property
+    def matrix_t(self):
+        """`matrix.T` in CSR format. Multiplying queries by `matrix.T`
+        directly converts all of `matrix` on every call, which costs
+        several milliseconds for the full train split."""
+        if self._matrix_t is None:
+            self._matrix_t = self.matrix.T.tocsr()
+        return self._matrix_t
+
+    @staticmethod
+    def split_fingerprint(split_df):
+        return hashlib.sha1(pd.util.hash_pandas_object(
+            split_df[["input", "output"]], index=False).to_numpy().tobytes()
+        ).hexdigest()
+
+    @classmethod
+    def from_split(cls, split_df, lexicon=None, ngram_range=(1, 3),
+            max_df=0.9):
+        """Build an index from `split_df`, which must contain only
+        "in_distribution" examples, like `dataset['train']`. The
+        vocabulary and IDF weights are fit with scikit-learn's
+        `TfidfVectorizer`, which is not needed after that.
+
+        Parameters
+        ----------
+        split_df: pd.DataFrame
+        lexicon: dict or None
+        ngram_range: tuple of int
+        max_df: float
+            Words in more than this proportion of the documents (like
+            "." and "a") are ignored.
+
+        Returns
+        -------
+        `DemoIndex`
+        """
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        categories = set(split_df.category.unique())
+        if categories - {"in_distribution"}:
+            raise ValueError(
+                "Demos can only come from in-distribution examples "
+                f"(like `dataset['train']`), not {sorted(categories)}.")
+        split_df = split_df.reset_index(drop=True)
+        docs = split_df.input
+        if lexicon is not None:
+            tokens = docs.str.split().explode()
+            tokens = tokens.map(lexicon).fillna(tokens)
+            docs = tokens.groupby(level=0).agg(" ".join)
+        vectorizer = TfidfVectorizer(
+            lowercase=False,
+            token_pattern=r"\S+",
+            ngram_range=ngram_range,
+            max_df=max_df,
+            sublinear_tf=True,
+            dtype=np.float32)
+        matrix = vectorizer.fit_transform(docs).tocsr()
+        # Identical documents have identical vectors, so only one row
+        # is kept for each:
+        doc_ids, _ = pd.factorize(docs)
+        _, first_rows = np.unique(doc_ids, return_index=True)
+        exact = {
+            doc: indices[: cls.max_exact]
+            for doc, indices in docs.groupby(docs.to_numpy()).indices.items()}
+        return cls(
+            {term: int(col) for term, col in vectorizer.vocabulary_.items()},
+            vectorizer.idf_.astype(np.float32),
+            matrix[first_rows],
+            doc_ids.astype(np.int32),
+            split_df.input.to_numpy(dtype=object),
+            split_df.output.to_numpy(dtype=object),
+            ngram_range=ngram_range,
+            lexicon=lexicon,
+            fingerprint=cls.split_fingerprint(split_df),
+            exact=exact)
+
+    def _documents(self, X):
+        if self.lexicon is None:
+            return list(X)
+        return [
+            " ".join(self.lexicon.get(tok, tok) for tok in x.split())
+            for x in X]
+
+    def _vectorize(self, docs):
+        """TF-IDF vectors for `docs`, computed as `TfidfVectorizer`
+        does at build time (whitespace tokens, word n-grams, sublinear
+        TF, L2 norm), but with just dict lookups into `vocabulary`.
+        N-grams not in `vocabulary` are ignored."""
+        import scipy.sparse
+
+        min_n, max_n = self.ngram_range
+        indptr = [0]
+        indices = []
+        counts = []
+        for doc in docs:
+            tokens = doc.split()
+            row = collections.Counter()
+            for n in range(min_n, max_n + 1):
+                ngrams = tokens if n == 1 else map(
+                    " ".join, zip(*[tokens[i:] for i in range(n)]))
+                for ngram in ngrams:
+                    col = self.vocabulary.get(ngram)
+                    if col is not None:
+                        row[col] += 1
+            indices.extend(row.keys())
+            counts.extend(row.values())
+            indptr.append(len(indices))
+        indices = np.asarray(indices, dtype=np.int32)
+        indptr = np.asarray(indptr, dtype=np.int32)
+        data = np.log(np.asarray(counts, dtype=np.float32)) + np.float32(1)
+        data *= self.idf[indices]
+        rows = np.repeat(np.arange(len(docs)), np.diff(indptr))
+        norms = np.sqrt(np.bincount(
+            rows, weights=data * data, minlength=len(docs))).astype(np.float32)
+        norms[norms == 0] = 1
+        data /= norms[rows]
+        return scipy.sparse.csr_matrix(
+            (data, indices, indptr), shape=(len(docs), len(self.idf)))
+
+    def search(self, X, k=2, batch_size=256):
+        """Indices of the `k` most similar train examples for each
+        member of `X`, most similar first.
+
+        Returns
+        -------
+        np.array of shape (len(X), k)
+        """
+        docs = self._documents(X)
+        k = min(k, len(self.doc_ids))
+        results = np.zeros((len(docs), k), dtype=np.int64)
+        # Identical documents are the most similar, with ties broken in
+        # favor of earlier examples, as below:
+        misses = []
+        for i, doc in enumerate(docs):
+            indices = self.exact.get(doc)
+            if indices is not None and len(indices) >= k:
+                results[i] = indices[: k]
+            else:
+                misses.append(i)
+        k_docs = min(k, self.matrix.shape[0])
+        for start in range(0, len(misses), batch_size):
+            rows = misses[start: start + batch_size]
+            queries = self._vectorize([docs[i] for i in rows])
+            scores = (queries @ self.matrix_t).toarray()
+            kth = -np.partition(-scores, k_docs - 1, axis=1)[:, k_docs - 1]
+            for i, doc_scores, threshold in zip(rows, scores, kth):
+                # Each of the top `k` examples is among the first `k`
+                # examples of a document scoring at least the `k`th best
+                # document score. Ranking just those candidates by score
+                # and then index breaks ties in favor of earlier examples
+                # (`argpartition` would choose arbitrarily among them):
+                top_docs = np.flatnonzero(doc_scores >= threshold)
+                lengths = np.minimum(self._doc_counts[top_docs], k)
+                offsets = np.cumsum(lengths) - lengths
+                positions = np.arange(lengths.sum()) + np.repeat(
+                    self._doc_starts[top_docs] - offsets, lengths)
+                candidates = self._doc_examples[positions]
+                order = np.lexsort(
+                    (candidates, -doc_scores[self.doc_ids[candidates]]))
+                results[i] = candidates[order[: k]]
+        return results
+
+    def select_many(self, X, k=2):
+        """`(input, output)` demo pairs for each member of `X`."""
+        return [
+            list(zip(self.inputs[row], self.outputs[row]))
+            for row in self.search(X, k=k)]
+
+    def select(self, x, k=2):
+        """Demos for the single input `x`."""
+        return self.select_many([x], k=k)[0]
+
+    __call__ = select
+
+    def save(self, dirname):
+        """Save the index to `dirname` as plain arrays: the vocabulary
+        (in column order), the IDF weights, and the document ids with
+        `np.save`, `matrix` with `scipy.sparse.save_npz`, and the
+        rest as JSON. The JSON file is written last, and `load`
+        requires it, so a partially written index is never used.
+
+        Parameters
+        ----------
+        dirname: str
+            Created if necessary.
+        """
+        import scipy.sparse
+
+        os.makedirs(dirname, exist_ok=True)
+        config_filename = os.path.join(dirname, self.config_filename)
+        if os.path.exists(config_filename):
+            os.remove(config_filename)
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.save(
+            os.path.join(dirname, "vocabulary.npy"), np.array(terms, dtype=str))
+        np.save(os.path.join(dirname, "idf.npy"), self.idf)
+        np.save(os.path.join(dirname, "doc_ids.npy"), self.doc_ids)
+        scipy.sparse.save_npz(
+            os.path.join(dirname, "matrix.npz"), self.matrix, compressed=False)
+        config = {
+            "ngram_range": list(self.ngram_range),
+            "lexicon": self.lexicon,
+            "fingerprint": self.fingerprint,
+            "inputs": self.inputs.tolist(),
+            "outputs": self.outputs.tolist(),
+            "exact": {
+                doc: [int(i) for i in indices]
+                for doc, indices in self.exact.items()}}
+        tmp_filename = f"{config_filename}.tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(config, f)
+        os.replace(tmp_filename, config_filename)
+
+    @classmethod
+    def load(cls, dirname):
+        """Load an index written by `save`.
+
+        Parameters
+        ----------
+        dirname: str
+
+        Returns
+        -------
+        `DemoIndex`
+        """
+        import scipy.sparse
+
+        with open(os.path.join(dirname, cls.config_filename)) as f:
+            config = json.load(f)
+        terms = np.load(os.path.join(dirname, "vocabulary.npy")).tolist()
+        return cls(
+            {term: col for col, term in enumerate(terms)},
+            np.load(os.path.join(dirname, "idf.npy")),
+            scipy.sparse.load_npz(os.path.join(dirname, "matrix.npz")).tocsr(),
+            np.load(os.path.join(dirname, "doc_ids.npy")),
+            np.array(config["inputs"], dtype=object),
+            np.array(config["outputs"], dtype=object),
+            ngram_range=config["ngram_range"],
+            lexicon=config["lexicon"],
+            fingerprint=config["fingerprint"],
+            exact=config["exact"])
+
+def get_demo_index(dirname, split_df, **kwargs):
+    """The `DemoIndex` saved in `dirname` if it was built from
+    `split_df` with the same `lexicon`, else a new one built from
+    `split_df` and saved there. `kwargs` are as for
+    `DemoIndex.from_split`."""
+    if os.path.exists(os.path.join(dirname, DemoIndex.config_filename)):
+        index = DemoIndex.load(dirname)
+        if (index.fingerprint == DemoIndex.split_fingerprint(split_df)
+                and index.lexicon == kwargs.get("lexicon")):
+            return index
+    index = DemoIndex.from_split(split_df, **kwargs)
+    index.save(dirname)
+    return index
+
+def benchmark_demo_index(train_df, dev_df, dirname="demo_index", k=2,
+        lexicon=None):
+    """Build, save, and load times for a `DemoIndex` of `train_df`;
+    per-example query latency for single and batched queries over
+    `dev_df`; and, if `lexicon` is given, how often the top demo has
+    the same skeleton as the dev input, compared with random demos."""
+    start = time.perf_counter()
+    index = DemoIndex.from_split(train_df, lexicon=lexicon)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.save(dirname)
+    save_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index = DemoIndex.load(dirname)
+    load_seconds = time.perf_counter() - start
+    X = list(dev_df.input)
+    n_single = min(len(X), 200)
+    start = time.perf_counter()
+    for x in X[: n_single]:
+        index.select(x, k=k)
+    single_ms = (time.perf_counter() - start) / n_single * 1000
+    start = time.perf_counter()
+    top = index.search(X, k=k)
+    batched_ms = (time.perf_counter() - start) / len(X) * 1000
+    size = sum(
+        os.path.getsize(os.path.join(dirname, name))
+        for name in os.listdir(dirname))
+    print(f"build: {build_seconds:.2f}s, save: {save_seconds:.2f}s, "
+          f"load: {load_seconds:.2f}s, "
+          f"size: {size / 1e6:.1f}MB")
+    print(f"query: {single_ms:.3f}ms/example single, "
+          f"{batched_ms:.3f}ms/example batched")
+    if lexicon is not None:
+        skeletons = np.array(index._documents(index.inputs), dtype=object)
+        dev_skeletons = np.array(index._documents(X), dtype=object)
+        retrieved = np.mean(skeletons[top[:, 0]] == dev_skeletons)
+        rng = np.random.default_rng(0)
+        sampled_rows = rng.integers(len(skeletons), size=len(X))
+        sampled = np.mean(skeletons[sampled_rows] == dev_skeletons)
+        print(f"top demo has the same skeleton: {retrieved:.3f} "
+              f"(random demo: {sampled:.3f})")
+    return index
+
+# demo_index = benchmark_demo_index(
+#     dataset['train'], dataset['dev'],
+#     lexicon=TemplateIndex.from_split(dataset['train']).lexicon)
+
+# @dsp.transformation
+# def recogs_dsp_retrieval(example, index=demo_index, k=2):
+#     example.demos = [dsp.Example(input=x, output=y)
+#                      for x, y in index.select(example.input, k=k)]
+#     example, completions = dsp.generate(cogs_template)(example, stage='qa')
+#     return completions
+
+"""With the `lm` from the set-up, the optional assessment above becomes:"""
+
+# recogs_icl = RecogsICL(
+#     LMDispatcher(
+#         lm,
+#         cache=CompletionCache(os.path.join(root_path, 'cache', 'completions.sqlite')),
+#         concurrency=16),
+#     dataset['train'],
+#     k=2,
+#     demo_selector=demo_index)
+
+# ssamp = dataset['dev'].sample(200, random_state=0)
+
+# ssamp['prediction'] = recogs_icl.predict(ssamp.input)
+
+# ssamp['correct'] = batch_exact_match(ssamp.output, ssamp.prediction)
+
+# ssamp['correct'].sum() / ssamp.shape[0]
+
 """## Question 4: Original System [3 points]
 
 For your original system, you can do anything at all. The only constraint (repeated from above):
@@ -845,29 +4424,36 @@ In the cell below, please provide a brief technical description of your original
 
 # START COMMENT: Enter your system description in this cell.
 import torch.nn as nn
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
 class T5BaseRecogsModule(nn.Module):
-    def __init__(self):
+    precision = "fp32"
+
+    def __init__(self, config=None):
         super().__init__()
-        self.encdec = AutoModelForSeq2SeqLM.from_pretrained("t5-small")
+        from transformers import AutoModelForSeq2SeqLM
+        if config is None:
+            self.encdec = AutoModelForSeq2SeqLM.from_pretrained("t5-small")
+        else:
+            self.encdec = AutoModelForSeq2SeqLM.from_config(config)
 
     def forward(self, X_pad, X_mask, y_pad, y_mask, labels=None):
-        outputs = self.encdec(
-            input_ids=X_pad, 
-            attention_mask=X_mask,
-            decoder_attention_mask=y_mask,
-            labels=y_pad)
+        with get_autocast(X_pad.device.type, self.precision):
+            outputs = self.encdec(
+                input_ids=X_pad, 
+                attention_mask=X_mask,
+                decoder_attention_mask=y_mask,
+                labels=y_pad)
         return outputs
 
 class T5BaseRecogsModel(RecogsModel):
     def __init__(self, *args, initialize=True, **kwargs):
-        super().__init__(*args, **kwargs)
+        super().__init__(*args, initialize=initialize, **kwargs)
+        from transformers import AutoTokenizer
         self.enc_tokenizer = AutoTokenizer.from_pretrained("t5-small")
         self.dec_tokenizer = self.enc_tokenizer
 
     def build_graph(self):
-        return T5BaseRecogsModule()
+        return T5BaseRecogsModule(config=self._encdec_config)
 
 # t5BaseModel = T5BaseRecogsModel(batch_size=5,
 #     gradient_accumulation_steps=20,
@@ -882,36 +4468,151 @@ class T5BaseRecogsModel(RecogsModel):
 """Assess"""
 
 def test_gen_acc(model, cnt):
-    cats = dataset['gen'].head(cnt).category.unique()
-    avg_acc = 0
-    for cat in cats:
-        result_df = category_assess(dataset['gen'].head(cnt), model, cat)
-        acc = result_df.correct.sum() / result_df.shape[0]
-        avg_acc += acc
-        print('catrgory:', cat)
-        print('accuracy:', acc)
-    avg_acc /= len(cats)
-    print(avg_acc)
-    return avg_acc
-
-parameters = [0.00001, 0.00005]
-best_model = None
-best_acc = 0
-for para in parameters:
-    t5BaseModel = T5BaseRecogsModel(batch_size=5,
-    gradient_accumulation_steps=20,
-    max_iter=5, 
-    early_stopping=True,
-    n_iter_no_change=10,
-    optimizer_class=torch.optim.Adam,
-    eta=para)
-    _ = t5BaseModel.fit(dataset['train'].input, dataset['train'].output)
-    
-    torch.save(t5BaseModel, 't5Model_' + para + '_5')
-    acc = test_gen_acc(t5BaseModel, 1000)
-    if acc > best_acc:
-        best_model = t5BaseModel
-        acc = best_acc
+    _, summary_df = evaluate_categories(get_dataset()['gen'].head(cnt), model)
+    print(summary_df)
+    return summary_df.accuracy["macro"]
+
+"""`run_sweep` fits one model per learning rate. With `n_jobs > 1`, it runs several configurations at once in a process pool, dividing the CPU threads evenly among the workers. The train and gen splits are tokenized once, up front, into the models' `TokenCache`, and every worker reads the same memory-mapped arrays from there. Workers are started with the "spawn" method, which is safe with torch's thread pools and works because importing this module is cheap."""
+
+SWEEP_MODEL_KWARGS = {
+    "batch_size": 5,
+    "gradient_accumulation_steps": 20,
+    "early_stopping": True,
+    "n_iter_no_change": 10,
+    "optimizer_class": torch.optim.Adam}
+
+def _add_sweep_sources(model, cnt):
+    """Register the train and gen columns with `model.token_cache`, so
+    that `fit` and `predict` read their token ids from the cache."""
+    if model.token_cache is None:
+        return
+    dataset = get_dataset()
+    for texts, tokenizer in (
+            (dataset['train'].input, model.enc_tokenizer),
+            (dataset['train'].output, model.dec_tokenizer),
+            (dataset['gen'].input.head(cnt), model.enc_tokenizer)):
+        model.token_cache.add_source(texts, tokenizer)
+
+def run_sweep_config(model_class, model_kwargs, cnt, filename,
+        n_threads=None, return_model=True):
+    """Fit and assess one sweep configuration.
+
+    Parameters
+    ----------
+    model_class: `RecogsModel` subclass
+    model_kwargs: dict
+    cnt: int
+        Number of gen examples to assess on.
+    filename: str
+        Directory where the fitted model is saved with `save`.
+    n_threads: int or None
+        Passed to `torch.set_num_threads`.
+    return_model: bool
+        Whether to return the fitted model along with the results.
+
+    Returns
+    -------
+    dict of results, and the model if `return_model`
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    dataset = get_dataset()
+    model = model_class(**model_kwargs)
+    _add_sweep_sources(model, cnt)
+    start = time.perf_counter()
+    model.fit(dataset['train'].input, dataset['train'].output)
+    fit_seconds = time.perf_counter() - start
+    n_epochs = len(getattr(model, "errors", [])) or model.max_iter
+    start = time.perf_counter()
+    _, summary_df = evaluate_categories(dataset['gen'].head(cnt), model)
+    eval_seconds = time.perf_counter() - start
+    model.save(filename)
+    results = {
+        "eta": model_kwargs.get("eta"),
+        "fit_seconds": fit_seconds,
+        "train_examples_per_second": (
+            n_epochs * dataset['train'].shape[0] / fit_seconds),
+        "eval_seconds": eval_seconds,
+        "gen_examples_per_second": summary_df.examples["micro"] / eval_seconds,
+        "macro_accuracy": summary_df.accuracy["macro"],
+        "micro_accuracy": summary_df.accuracy["micro"],
+        "filename": filename}
+    if return_model:
+        return results, model
+    return results
+
+def run_sweep(parameters=(0.00001, 0.00005), cnt=1000, max_iter=5,
+        n_jobs=1, model_class=None, model_kwargs=None,
+        results_filename="sweep_results.tsv"):
+    """Fit a model for each learning rate in `parameters`, saving each
+    one and assessing it with `evaluate_categories` on the first `cnt`
+    gen examples.
+
+    Parameters
+    ----------
+    parameters: iterable of float
+    cnt: int
+    max_iter: int
+    n_jobs: int
+        Number of configurations to run at once; -1 means one per CPU.
+    model_class: `RecogsModel` subclass or None
+        Default: `T5BaseRecogsModel`.
+    model_kwargs: dict or None
+        Default: `SWEEP_MODEL_KWARGS`.
+    results_filename: str or None
+        Where the results table is written as a TSV.
+
+    Returns
+    -------
+    best_model, results_df
+        `results_df` has one row per configuration, with wall times,
+        throughput, and accuracy, sorted by macro accuracy
+    """
+    model_class = T5BaseRecogsModel if model_class is None else model_class
+    model_kwargs = SWEEP_MODEL_KWARGS if model_kwargs is None else model_kwargs
+    configs = [
+        ({**model_kwargs, "max_iter": max_iter, "eta": para},
+         f"t5Model_{para}_{max_iter}")
+        for para in parameters]
+    n_jobs = min(resolve_n_jobs(n_jobs), len(configs))
+    start = time.perf_counter()
+    best_model = None
+    if n_jobs == 1:
+        results = []
+        for kwargs, filename in configs:
+            result, model = run_sweep_config(model_class, kwargs, cnt, filename)
+            if not results or result["macro_accuracy"] > max(
+                    r["macro_accuracy"] for r in results):
+                best_model = model
+            results.append(result)
+    else:
+        # Tokenize once here, so that the workers only read the cache:
+        _add_sweep_sources(
+            model_class(initialize=False, **model_kwargs), cnt)
+        n_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_jobs, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    run_sweep_config, model_class, kwargs, cnt, filename,
+                    n_threads=n_threads, return_model=False)
+                for kwargs, filename in configs]
+            results = [future.result() for future in futures]
+    sweep_seconds = time.perf_counter() - start
+    results_df = pd.DataFrame(results).sort_values(
+        "macro_accuracy", ascending=False, ignore_index=True)
+    print(results_df.to_string())
+    print(f"Sweep of {len(configs)} configurations with n_jobs={n_jobs}: "
+          f"{sweep_seconds:.1f}s")
+    if results_filename is not None:
+        results_df.to_csv(results_filename, sep="\t", index=False)
+    if best_model is None:
+        best_model = model_class.load(results_df.filename[0])
+    return best_model, results_df
+
+if __name__ == "__main__":
+    best_model, sweep_df = run_sweep()
 
 
 
@@ -994,16 +4695,57 @@ This is very easy to do. For example, here we do some training on the first 10 d
 # Here we read in the bakeoff dataset:
 # """
 
-bakeoff_df = pd.read_csv(
-    os.path.join(SRC_DIRNAME, "cs224u-recogs-test-unlabeled.tsv"), 
-    sep="\t", index_col=0)
+@functools.lru_cache(maxsize=None)
+def get_bakeoff_df():
+    return load_split(
+        os.path.join(SRC_DIRNAME, "cs224u-recogs-test-unlabeled.tsv"), 
+        sep="\t", index_col=0)
 
-preds = best_model.predict(bakeoff_df.input)
-bakeoff_df['prediction'] = preds
+if __name__ == "__main__":
+    bakeoff_df = get_bakeoff_df()
 
 # """For the bakeoff entry, you should add a column "prediction" containing your predicted LFs and then use the following command to write the file to disk:"""
 
-bakeoff_df.to_csv("cs224u-recogs-bakeoff-entry.tsv", sep="\t")
+def write_bakeoff_entry(model, bakeoff_df,
+        filename="cs224u-recogs-bakeoff-entry.tsv",
+        checkpoint_filename=None):
+    """Predict `bakeoff_df.input` with `model` and write the entry to
+    `filename`. Predictions are streamed to `checkpoint_filename` as
+    they are made, so rerunning this after an interruption picks up
+    where the previous run stopped. The checkpoint is deleted once
+    `filename` has been written.
+
+    Parameters
+    ----------
+    model: `RecogsModel`
+    bakeoff_df: pd.DataFrame
+    filename: str
+    checkpoint_filename: str or None
+        Default: `filename` with the model's `fingerprint` and
+        ".partial.jsonl" appended, so that a checkpoint is only ever
+        resumed by the same model (weights and generation settings).
+        Models without a `fingerprint` are not checkpointed by default.
+
+    Returns
+    -------
+    pd.DataFrame
+        `bakeoff_df` with a "prediction" column added
+    """
+    if checkpoint_filename is None and hasattr(model, "fingerprint"):
+        checkpoint_filename = f"{filename}.{model.fingerprint()}.partial.jsonl"
+    sink = None
+    if checkpoint_filename is not None:
+        sink = PredictionSink(checkpoint_filename)
+    bakeoff_df = bakeoff_df.copy()
+    bakeoff_df['prediction'] = collect_predictions(
+        model, bakeoff_df.input, sink=sink)
+    bakeoff_df.to_csv(filename, sep="\t")
+    if checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+    return bakeoff_df
+
+if __name__ == "__main__":
+    bakeoff_df = write_bakeoff_entry(best_model, bakeoff_df)
 
 # """Here is what the first couple of lines of the file should look like:
 
@@ -1049,4 +4791,52 @@ def test_bakeoff_file(filename="cs224u-recogs-bakeoff-entry.tsv"):
     if errcount == 0:
         print("Bakeoff file seems to be in good shape!")
 
-test_bakeoff_file()
\ No newline at end of file
+if __name__ == "__main__":
+    test_bakeoff_file()
+
+"""### Lazy module attributes
+
+When this file is imported as a module, the names that the cells above create when it is run as a script are provided lazily by the cached accessors, through a module-level `__getattr__` ([PEP 562](https://peps.python.org/pep-0562/)). `benchmark_import_time` checks that importing the module stays cheap."""
+
+import subprocess
+
+_LAZY_ATTRIBUTES = {
+    "dataset": lambda: get_dataset(),
+    "gen_df": lambda: get_dataset()["gen"],
+    "enc_tokenizer": get_enc_tokenizer,
+    "dec_tokenizer": get_dec_tokenizer,
+    "encdec": get_encdec,
+    "recogs_model": get_recogs_model,
+    "bakeoff_df": get_bakeoff_df}
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def benchmark_import_time(module="hw_recogs", top=10):
+    """Import `module` in a fresh interpreter with `python -X importtime`
+    and report the total time and the `top` slowest imports.
+
+    Returns
+    -------
+    float
+        Total import time in seconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        # Lines look like "import time: self [us] | cumulative | name":
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        rows.append((int(cumulative), name.strip()))
+    total = next(us for us, name in rows if name == module) / 1e6
+    print(f"import {module}: {total:.3f}s")
+    for us, name in sorted(rows, reverse=True)[: top]:
+        print(f"    {us / 1e6:.3f}s  {name}")
+    return total
+
+# benchmark_import_time()